@@ -1,10 +1,18 @@
+import time
+
 import glfw
 import moderngl
 import imgui
 from imgui.integrations.glfw import GlfwRenderer as ImguiRenderer
 
+from profiler import profiler
+
 class App:
-    def __init__(self, width = 640, height = 480, title = "Hello world"):
+    def __init__(self, width = 640, height = 480, title = "Hello world", start_time = None):
+        # Reference of the time to first frame, the creation of the app if
+        # the caller did not record an earlier one
+        self.start_time = time.perf_counter() if start_time is None else start_time
+        self.first_frame_time = None
         imgui.create_context()
 
         if not glfw.init():
@@ -27,6 +35,11 @@ class App:
         glfw.set_char_callback(self.window, self._on_char)
         glfw.set_scroll_callback(self.window, self._on_scroll)
 
+        # Latest cursor position not handled by on_frame_mouse_move yet
+        self._pending_mouse_move = None
+        # Mouse button being released, still held for the input before it
+        self._releasing = None
+
         self.init()
 
     def main_loop(self):
@@ -37,36 +50,64 @@ class App:
 
         # Loop until the user closes the window
         while not glfw.window_should_close(self.window):
-            glfw.poll_events()
-            self.impl.process_inputs()
-
-            current_time = glfw.get_time()
-            delta_time = current_time - previous_time
-            previous_time = current_time
-            self.update(current_time, delta_time)
-            self.render()
+            with profiler.scope("frame"):
+                with profiler.scope("events"):
+                    glfw.poll_events()
+                    self.impl.process_inputs()
+
+                with profiler.scope("input"):
+                    self._process_input()
+
+                current_time = glfw.get_time()
+                delta_time = current_time - previous_time
+                previous_time = current_time
+                with profiler.scope("update"):
+                    self.update(current_time, delta_time)
+                with profiler.scope("render"):
+                    self.render()
+
+                with profiler.scope("ui"):
+                    imgui.new_frame()
+                    self.ui()
+                    imgui.render()
+                    self.impl.render(imgui.get_draw_data())
+
+                with profiler.scope("swap"):
+                    glfw.swap_buffers(self.window)
+
+            if self.first_frame_time is None:
+                self.first_frame_time = time.perf_counter() - self.start_time
+                print(f"(First frame after {self.first_frame_time * 1e3:.0f} ms)")
+                self.on_first_frame()
 
-            imgui.new_frame()
-            self.ui()
-            imgui.render()
-            self.impl.render(imgui.get_draw_data())
-
-            # Check if the left mouse button is pressed
-            if glfw.get_mouse_button(self.window, glfw.MOUSE_BUTTON_LEFT) == glfw.PRESS:
-                self._on_left_mouse_button_held()
+        self.impl.shutdown()
+        glfw.terminate()
 
-            # Check if the right mouse button is pressed
-            if glfw.get_mouse_button(self.window, glfw.MOUSE_BUTTON_RIGHT) == glfw.PRESS:
-                self._on_right_mouse_button_held()
+    def _process_input(self):
+        """Apply the input accumulated since the last frame, once, before
+        rendering: however many cursor events arrived, only the latest
+        position is handed to on_frame_mouse_move."""
+        if self._pending_mouse_move is not None:
+            x, y = self._pending_mouse_move
+            self._pending_mouse_move = None
+            self.on_frame_mouse_move(x, y)
 
-            glfw.swap_buffers(self.window)
+        # Check if the left mouse button is pressed
+        if self.mouse_button_held(glfw.MOUSE_BUTTON_LEFT):
+            self._on_left_mouse_button_held()
 
-        self.impl.shutdown()
-        glfw.terminate()
+        # Check if the right mouse button is pressed
+        if self.mouse_button_held(glfw.MOUSE_BUTTON_RIGHT):
+            self._on_right_mouse_button_held()
 
     def should_close(self):
         glfw.set_window_should_close(self.window, True)
 
+    def mouse_button_held(self, button):
+        """Whether `button` is pressed, or being released while the input
+        received before its release is applied"""
+        return button == self._releasing or glfw.get_mouse_button(self.window, button) == glfw.PRESS
+
     def mouse_pos(self):
         return glfw.get_cursor_pos(self.window)
 
@@ -76,6 +117,10 @@ class App:
     def init(self):
         pass
 
+    def on_first_frame(self):
+        """Called once the first frame is displayed, to start deferred work"""
+        pass
+
     def update(self, time):
         pass
 
@@ -102,12 +147,24 @@ class App:
     def _on_mouse_move(self, window, x, y):
         self.impl.mouse_callback(window, x, y)
         self.on_mouse_move(x, y)
+        self._pending_mouse_move = x, y
 
     def on_mouse_move(self, x, y):
+        """Called for every cursor event, for cheap updates only"""
+        pass
+
+    def on_frame_mouse_move(self, x, y):
+        """Called at most once per frame with the latest cursor position"""
         pass
 
     def _on_mouse_button(self, window, button, action, mods):
         if not imgui.get_io().want_capture_mouse:
+            if action == glfw.RELEASE:
+                # The cursor moved since the last frame with the button held,
+                # and this motion is applied before the release
+                self._releasing = button
+                self._process_input()
+                self._releasing = None
             self.on_mouse_button(button, action, mods)
 
     def on_mouse_button(self, button, action, mods):
@@ -1,7 +1,6 @@
 import numpy as np
-from scipy.spatial.transform import Rotation
 
-from utils import perspective
+from utils import perspective, rotation_x, rotation_y
 
 class Camera:
     def __init__(self, width, height):
@@ -10,7 +9,7 @@ class Camera:
         self.momentum = 0.93
 
         self._zoom = 2
-        self.rot = Rotation.identity()
+        self.rot = np.eye(3)
         self.previous_mouse_pos = None
         self.angular_velocity = None
         self.rot_around_vertical = 0
@@ -29,12 +28,10 @@ class Camera:
         if self.previous_mouse_pos is None and self.angular_velocity is not None:
             self._damping()
 
-        self.rot = Rotation.identity()
-        self.rot *= Rotation.from_rotvec(self.rot_around_horizontal * np.array([1,0,0]))
-        self.rot *= Rotation.from_rotvec(self.rot_around_vertical * np.array([0,1,0]))
+        self.rot = rotation_x(self.rot_around_horizontal) @ rotation_y(self.rot_around_vertical)
 
         viewMatrix = np.eye(4)
-        viewMatrix[:3,:3] = self.rot.as_matrix()
+        viewMatrix[:3,:3] = self.rot
         viewMatrix[0:3,3] = 0, 0, -self._zoom
         self.viewMatrix = viewMatrix
 
@@ -73,32 +70,42 @@ class Camera:
             self._rotate(dx * self.momentum, dy * self.momentum)
 
     def screen_to_world_ray(self, x, y):
+        eye_position, ray_directions = self.screen_to_world_rays([x], [y])
+        return eye_position, ray_directions[0]
+
+    def pixel_centers(self, xs, ys):
+        """Centers of the pixels under screen positions. Picking samples
+        them, on the CPU as on the GPU, so that both paths hit the same
+        points."""
+        return np.floor(xs) + 0.5, np.floor(ys) + 0.5
+
+    def screen_to_world_rays(self, xs, ys):
+        """Rays through many screen positions at once: the eye position, and
+        one unit direction per position"""
         # Convert screen coordinates to normalized device coordinates (NDC)
-        x = 2.0 * x / self.width - 1.0
-        y = 1.0 - 2.0 * y / self.height
+        x = 2.0 * np.asarray(xs, dtype=np.float64) / self.width - 1.0
+        y = 1.0 - 2.0 * np.asarray(ys, dtype=np.float64) / self.height
 
-        # Clip coordinates
-        clip_coords = np.array([x, y, -1.0, 1.0], dtype=np.float32)
-        # Compute the inverse of the projection matrix
+        # Clip coordinates, one row per position
+        clip_coords = np.stack([x, y, -np.ones_like(x), np.ones_like(x)], axis=1)
+        # The matrices are inverted once for all the positions
         inv_proj_matrix = np.linalg.inv(self.perspectiveMatrix)
-
-        # Transform clip coordinates to view space
-        view_space_pos = inv_proj_matrix @ clip_coords
-        view_space_pos[2] = -1.0  # Set to -1 for a forward-facing ray
-        view_space_pos[3] = 0.0   # Set to 0 for a direction vector
-
-        # Compute the inverse of the view matrix
         inv_view_matrix = np.linalg.inv(self.viewMatrix)
         eye_position = inv_view_matrix[:3, 3]
 
+        # Transform clip coordinates to view space
+        view_space_pos = clip_coords @ inv_proj_matrix.T
+        view_space_pos[:, 2] = -1.0  # Set to -1 for a forward-facing ray
+        view_space_pos[:, 3] = 0.0   # Set to 0 for a direction vector
+
         # Transform view space coordinates to world space
-        world_space_pos = inv_view_matrix @ view_space_pos
+        world_space_pos = view_space_pos @ inv_view_matrix.T
 
-        # Normalize the direction
-        ray_direction = world_space_pos[:3]
-        ray_direction /= np.linalg.norm(ray_direction)
+        # Normalize the directions
+        ray_directions = world_space_pos[:, :3]
+        ray_directions /= np.linalg.norm(ray_directions, axis=1, keepdims=True)
 
-        return eye_position,ray_direction
+        return eye_position,ray_directions
 
     def world_to_screen(self, world_pos):
         view_pos = self.viewMatrix @ np.array([*world_pos, 1])
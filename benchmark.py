@@ -0,0 +1,233 @@
+"""Benchmarks of every stage of the deformation pipeline.
+
+Usage:
+    python benchmark.py run [--output results.json] [--repeat N] [--subdivide L ...]
+    python benchmark.py compare baseline.json results.json [--threshold 0.1]
+
+`run` times each stage on the sample meshes, and on versions of them
+subdivided L times (each subdivision multiplies the face count by 4), then
+writes the timings as JSON. `compare` reports the stages whose median time
+grew by more than the threshold between two result files, and exits with a
+non-zero status if there is any."""
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from Camera import Camera
+import mesh_io
+from gpu_picking import GPUPicker
+from mesh import ObjMesh, RenderedMesh
+
+SAMPLE_MESHES = ["sample-data/dragon.obj", "sample-data/simplification.obj"]
+# Viewport and number of screen positions of the picking stages
+PICKING_VIEWPORT = (800, 600)
+PICKING_SAMPLES = 4096
+
+
+def timeit(function, repeat, setup=None):
+    """Timings of `function`, `setup` being called untimed before each run"""
+    runs = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        function()
+        runs.append(time.perf_counter() - start)
+    return {'median': statistics.median(runs), 'min': min(runs), 'runs': runs}
+
+
+def subdivided_copy(path, levels, directory):
+    import trimesh
+    mesh = trimesh.load(path)
+    vertices, faces = mesh.vertices, mesh.faces
+    for _ in range(levels):
+        vertices, faces = trimesh.remesh.subdivide(vertices, faces)
+    name = f"{os.path.splitext(os.path.basename(path))[0]}_sub{levels}"
+    output = os.path.join(directory, name + ".obj")
+    trimesh.Trimesh(vertices, faces, process=False).export(output)
+    return name, output
+
+
+def create_gl_context():
+    """Standalone moderngl context, or None if none can be created here"""
+    import moderngl
+    for kwargs in ({}, {'backend': 'egl'}):
+        try:
+            return moderngl.create_standalone_context(**kwargs)
+        except Exception:
+            pass
+    return None
+
+
+def scenario(objmesh):
+    """Deterministic fixed region and handle: the fixed region is a ball
+    around the lowest vertex, the handle is the highest vertex"""
+    vertices = objmesh.P
+    radius = 0.1 * np.linalg.norm(vertices.max(axis=0) - vertices.min(axis=0))
+    fixed = objmesh.vertices_in_ball(vertices[np.argmin(vertices[:, 1])], radius)
+    handle = vertices[np.argmax(vertices[:, 1])].copy()
+    return fixed, handle, 0.01 * radius
+
+
+def remove_cache(path):
+    if os.path.exists(path + mesh_io.CACHE_SUFFIX):
+        os.remove(path + mesh_io.CACHE_SUFFIX)
+
+
+def benchmark_mesh(path, repeat, ctx, directory):
+    stages = {}
+    # Loaded from a copy, whose cache is under control and which leaves the
+    # original untouched: parsed every time, then from the cache it wrote
+    copy = os.path.join(directory, "load-" + os.path.basename(path))
+    shutil.copyfile(path, copy)
+    stages['load_mesh (parse)'] = timeit(lambda: ObjMesh(copy), repeat, setup=lambda: remove_cache(copy))
+    stages['load_mesh (cached)'] = timeit(lambda: ObjMesh(copy), repeat)
+    objmesh = ObjMesh(copy)
+    stages['create_weighted_graph'] = timeit(objmesh.create_weighted_graph, repeat)
+
+    fixed, handle, shift = scenario(objmesh)
+    objmesh.add_fixed_region(fixed)
+    stages['_geodestic_distances_from_fixed_region'] = timeit(objmesh._geodestic_distances_from_fixed_region, repeat)
+    stages['calc_deformable_region'] = timeit(lambda: objmesh.calc_deformable_region(handle), repeat)
+
+    def deform():
+        objmesh.deform(handle, handle + shift)
+    stages['deform'] = timeit(deform, repeat)
+    stages['update_GL_variables'] = timeit(objmesh.update_GL_variables, repeat)
+
+    if ctx is not None:
+        program = ctx.program(
+            vertex_shader=open("shaders/mesh.vert.glsl").read(),
+            fragment_shader=open("shaders/mesh.frag.glsl").read(),
+        )
+        rendered_mesh = RenderedMesh(ctx, objmesh, program)
+
+        def update():
+            # Upload after a drag step, which is what happens while deforming
+            deform()
+            rendered_mesh.update()
+            ctx.finish()
+        stages['RenderedMesh.update'] = timeit(update, repeat)
+
+        # Brush positions over the viewport, picked on the CPU and the GPU
+        camera = Camera(*PICKING_VIEWPORT)
+        camera.update(0, 0)
+        rng = np.random.default_rng(0)
+        xs = rng.uniform(0, camera.width, PICKING_SAMPLES)
+        ys = rng.uniform(0, camera.height, PICKING_SAMPLES)
+        origin, directions = camera.screen_to_world_rays(*camera.pixel_centers(xs, ys))
+        picker = GPUPicker(ctx, rendered_mesh)
+        stages['intersect_rays'] = timeit(lambda: objmesh.intersect_rays(origin, directions), repeat)
+        stages['GPUPicker.pick_many'] = timeit(lambda: picker.pick_many(camera, xs, ys), repeat)
+        _, cpu_faces = objmesh.intersect_rays(origin, directions)
+        _, gpu_faces = picker.pick_many(camera, xs, ys)
+        hit = (cpu_faces >= 0) | (gpu_faces >= 0)
+        # Both paths sample pixel centers, so they should hit the same faces
+        picking_agreement = float((cpu_faces == gpu_faces)[hit].mean()) if hit.any() else 1.0
+        picker.release()
+        rendered_mesh.release()
+        program.release()
+
+    result = {
+        'vertices': len(objmesh.P),
+        'faces': len(objmesh.F),
+        'deformable_vertices': int(objmesh.deformable_region.sum()),
+        'stages': stages,
+    }
+    if ctx is not None:
+        result['picking_agreement'] = picking_agreement
+    return result
+
+
+def run(args):
+    ctx = create_gl_context()
+    if ctx is None:
+        print("No OpenGL context available, skipping RenderedMesh.update", file=sys.stderr)
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        meshes = [(os.path.splitext(os.path.basename(path))[0], path) for path in args.meshes]
+        for path in args.meshes:
+            for levels in args.subdivide:
+                meshes.append(subdivided_copy(path, levels, directory))
+        for name, path in meshes:
+            print(f"Benchmarking {name}...", file=sys.stderr)
+            results[name] = benchmark_mesh(path, args.repeat, ctx, directory)
+            for stage, timing in results[name]['stages'].items():
+                print(f"  {stage:40s} {timing['median'] * 1e3:10.2f} ms", file=sys.stderr)
+            if 'picking_agreement' in results[name]:
+                print(f"  {'CPU/GPU picked face agreement':40s} {results[name]['picking_agreement']:10.1%}", file=sys.stderr)
+
+    report = {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'gl_renderer': ctx.info['GL_RENDERER'] if ctx is not None else None,
+            'repeat': args.repeat,
+        },
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}", file=sys.stderr)
+    return 0
+
+
+def compare(args):
+    with open(args.baseline) as f:
+        baseline = json.load(f)['results']
+    with open(args.current) as f:
+        current = json.load(f)['results']
+
+    regressions = 0
+    for name in sorted(set(baseline) & set(current)):
+        print(name)
+        before, after = baseline[name]['stages'], current[name]['stages']
+        for stage in before:
+            if stage not in after:
+                continue
+            old, new = before[stage]['median'], after[stage]['median']
+            ratio = new / old if old > 0 else float('inf')
+            flag = ""
+            if ratio > 1 + args.threshold:
+                flag = "  REGRESSION"
+                regressions += 1
+            print(f"  {stage:40s} {old * 1e3:10.2f} ms -> {new * 1e3:10.2f} ms  x{ratio:.2f}{flag}")
+    print(f"{regressions} regression(s) beyond {args.threshold:.0%}")
+    return 1 if regressions else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the mesh deformation pipeline")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help="time every stage and write the results as JSON")
+    run_parser.add_argument('--output', default='benchmark.json')
+    run_parser.add_argument('--repeat', type=int, default=5)
+    run_parser.add_argument('--meshes', nargs='+', default=SAMPLE_MESHES)
+    run_parser.add_argument('--subdivide', type=int, nargs='*', default=[1, 2],
+                            help="subdivision levels of the synthetic larger meshes")
+    run_parser.set_defaults(function=run)
+
+    compare_parser = subparsers.add_parser('compare', help="flag regressions between two result files")
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--threshold', type=float, default=0.1,
+                                help="relative slowdown of the median flagged as a regression")
+    compare_parser.set_defaults(function=compare)
+
+    args = parser.parse_args(argv)
+    return args.function(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,181 @@
+import numpy as np
+
+
+class BVH:
+    """Bounding volume hierarchy over the triangles of a mesh, used for ray
+    picking. Nodes are stored in flat arrays: a node is a leaf when its left
+    child is -1, otherwise its right child is left + 1. Each node covers the
+    range [start, start + count) of the face permutation `order`.
+
+    When vertices move, `refit` recomputes the boxes of the leaves holding the
+    given faces and of their ancestors only, instead of rebuilding the tree."""
+    def __init__(self, vertices, faces, leaf_size=8):
+        self.faces = np.asarray(faces)
+        self.leaf_size = leaf_size
+        self._build(np.asarray(vertices))
+        self.refit(vertices)
+
+    def _build(self, vertices):
+        face_count = len(self.faces)
+        centroids = vertices[self.faces].mean(axis=1)
+        order = np.arange(face_count)
+        start, count, left, parent, depth = [0], [face_count], [-1], [-1], [0]
+
+        stack = [0]
+        while stack:
+            node = stack.pop()
+            s, c = start[node], count[node]
+            if c <= self.leaf_size:
+                continue
+            # Median split along the largest extent of the centroids
+            indices = order[s:s + c]
+            centers = centroids[indices]
+            axis = np.argmax(centers.max(axis=0) - centers.min(axis=0))
+            mid = c // 2
+            order[s:s + c] = indices[np.argpartition(centers[:, axis], mid)]
+
+            child = len(start)
+            left[node] = child
+            for child_start, child_count in ((s, mid), (s + mid, c - mid)):
+                start.append(child_start)
+                count.append(child_count)
+                left.append(-1)
+                parent.append(node)
+                depth.append(depth[node] + 1)
+            stack.extend((child, child + 1))
+
+        self.order = order
+        self.start = np.array(start)
+        self.count = np.array(count)
+        self.left = np.array(left)
+        self.parent = np.array(parent)
+        self.depth = np.array(depth)
+        self.leaves = np.flatnonzero(self.left < 0)
+
+        # Leaf holding each face
+        self.face_leaf = np.empty(face_count, dtype=np.int64)
+        leaves = self.leaves[np.argsort(self.start[self.leaves])]
+        self.face_leaf[order] = np.repeat(leaves, self.count[leaves])
+
+        self.box_min = np.empty((len(start), 3))
+        self.box_max = np.empty((len(start), 3))
+
+    def refit(self, vertices, faces=None):
+        """Update the boxes after the vertices moved. If `faces` is given, only
+        the boxes containing these faces are updated."""
+        vertices = np.asarray(vertices)
+        if faces is None:
+            leaves = self.leaves
+        else:
+            leaves = np.unique(self.face_leaf[faces])
+            if len(leaves) == 0:
+                return
+
+        # Leaf boxes, from the faces of every refitted leaf
+        counts = self.count[leaves]
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        leaf_faces = self.order[np.repeat(self.start[leaves], counts) + offsets]
+        triangles = vertices[self.faces[leaf_faces]]
+        segments = np.cumsum(counts) - counts
+        self.box_min[leaves] = np.minimum.reduceat(triangles.min(axis=1), segments)
+        self.box_max[leaves] = np.maximum.reduceat(triangles.max(axis=1), segments)
+
+        # Ancestors, deepest first so that children are up to date
+        ancestors = []
+        nodes = leaves
+        while True:
+            nodes = np.unique(self.parent[nodes])
+            nodes = nodes[nodes >= 0]
+            if len(nodes) == 0:
+                break
+            ancestors.append(nodes)
+        if not ancestors:
+            return
+        ancestors = np.unique(np.concatenate(ancestors))
+        depths = self.depth[ancestors]
+        for d in range(depths.max(), -1, -1):
+            nodes = ancestors[depths == d]
+            children = self.left[nodes]
+            self.box_min[nodes] = np.minimum(self.box_min[children], self.box_min[children + 1])
+            self.box_max[nodes] = np.maximum(self.box_max[children], self.box_max[children + 1])
+
+    def intersect(self, vertices, origins, directions):
+        """Closest hit of each ray. Returns the distance along the ray (inf on
+        a miss) and the index of the hit face (-1 on a miss).
+
+        The tree is traversed breadth first for all rays at once; a node is
+        skipped as soon as its box lies beyond the closest hit found so far."""
+        vertices = np.asarray(vertices)
+        origins = np.atleast_2d(np.asarray(origins, dtype=np.float64))
+        directions = np.atleast_2d(np.asarray(directions, dtype=np.float64))
+        ray_count = len(origins)
+        with np.errstate(divide='ignore'):
+            inverse_directions = 1.0 / directions
+        best_t = np.full(ray_count, np.inf)
+        best_face = np.full(ray_count, -1, dtype=np.int64)
+
+        rays = np.arange(ray_count)
+        nodes = np.zeros(ray_count, dtype=np.int64)
+        while len(rays) > 0:
+            # Slab test against the node boxes
+            with np.errstate(invalid='ignore'):
+                t0 = (self.box_min[nodes] - origins[rays]) * inverse_directions[rays]
+                t1 = (self.box_max[nodes] - origins[rays]) * inverse_directions[rays]
+            t_near = np.nanmax(np.minimum(t0, t1), axis=1)
+            t_far = np.nanmin(np.maximum(t0, t1), axis=1)
+            hit = (t_near <= t_far) & (t_far >= 0) & (t_near < best_t[rays])
+            rays, nodes = rays[hit], nodes[hit]
+
+            leaf = self.left[nodes] < 0
+            if leaf.any():
+                self._intersect_leaves(vertices, origins, directions,
+                                       rays[leaf], nodes[leaf], best_t, best_face)
+
+            rays, nodes = rays[~leaf], nodes[~leaf]
+            children = self.left[nodes]
+            rays = np.concatenate([rays, rays])
+            nodes = np.concatenate([children, children + 1])
+        return best_t, best_face
+
+    def _intersect_leaves(self, vertices, origins, directions, rays, nodes, best_t, best_face):
+        # Expand (ray, leaf) pairs to (ray, face) pairs
+        counts = self.count[nodes]
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        faces = self.order[np.repeat(self.start[nodes], counts) + offsets]
+        rays = np.repeat(rays, counts)
+
+        t = ray_triangle_intersection(origins[rays], directions[rays], vertices[self.faces[faces]])
+        closer = t < best_t[rays]
+        rays, faces, t = rays[closer], faces[closer], t[closer]
+        if len(rays) == 0:
+            return
+
+        # Closest candidate per ray
+        order = np.lexsort((t, rays))
+        rays, faces, t = rays[order], faces[order], t[order]
+        first = np.ones(len(rays), dtype=bool)
+        first[1:] = rays[1:] != rays[:-1]
+        best_t[rays[first]] = t[first]
+        best_face[rays[first]] = faces[first]
+
+
+def ray_triangle_intersection(origins, directions, triangles, epsilon=1e-12):
+    """Möller-Trumbore intersection of rays with triangles, pairwise. Returns
+    the distance along each ray, or inf where it misses its triangle."""
+    v0, v1, v2 = triangles[:, 0], triangles[:, 1], triangles[:, 2]
+    edge1 = v1 - v0
+    edge2 = v2 - v0
+    p = np.cross(directions, edge2)
+    determinant = np.einsum('ij,ij->i', edge1, p)
+    valid = np.abs(determinant) > epsilon
+    inverse_determinant = np.zeros_like(determinant)
+    inverse_determinant[valid] = 1.0 / determinant[valid]
+
+    s = origins - v0
+    u = np.einsum('ij,ij->i', s, p) * inverse_determinant
+    q = np.cross(s, edge1)
+    v = np.einsum('ij,ij->i', directions, q) * inverse_determinant
+    t = np.einsum('ij,ij->i', edge2, q) * inverse_determinant
+
+    hit = valid & (u >= 0) & (v >= 0) & (u + v <= 1) & (t > epsilon)
+    return np.where(hit, t, np.inf)
@@ -0,0 +1,146 @@
+"""Headless mesh deformation, without any window or GL context.
+
+Usage: python -m deform batch jobs.json [--workers N] [--chunk-size K]
+
+The jobs file holds a list of jobs (or an object with a "jobs" list). Each job
+is an object with the following keys, paths being relative to the jobs file:
+    mesh            path of the mesh to deform
+    fixed           indices of the fixed vertices, and/or
+    fixed_spheres   list of {"center": [x, y, z], "radius": r} brush spheres
+    handle          [x, y, z] position of the handle
+    displacement    [dx, dy, dz] shift applied to the handle
+    output          path of the exported mesh
+
+Jobs are spread over a process pool. Jobs targeting the same mesh are sent
+in chunks, and each process keeps the last mesh it loaded (with its graph),
+restoring the original vertices between jobs instead of reloading."""
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from mesh import ObjMesh
+
+# Path of the mesh last loaded by this process, the mesh and its undeformed
+# vertices. Only one is kept, chunks being made of the jobs of a single mesh,
+# so that memory does not grow with the number of meshes of a batch.
+_loaded = None
+
+
+def _load(path):
+    global _loaded
+    if _loaded is None or _loaded[0] != path:
+        # Released before the next mesh is loaded. Edits are not undone here.
+        _loaded = None
+        objmesh = ObjMesh(path, use_proxy=False, history_budget=0)
+        _loaded = (path, objmesh, objmesh.P.copy())
+    _, objmesh, original_vertices = _loaded
+    objmesh.set_vertices(original_vertices)
+    objmesh.clear_fixed_region()
+    return objmesh
+
+
+def run_job(job):
+    """Apply one deformation job and export the result"""
+    start = time.perf_counter()
+    objmesh = _load(job['mesh'])
+
+    fixed = [np.asarray(job.get('fixed', []), dtype=np.int64)]
+    for sphere in job.get('fixed_spheres', []):
+        fixed.append(objmesh.vertices_in_ball(sphere['center'], sphere['radius']))
+    fixed = np.concatenate(fixed)
+    if len(fixed) == 0:
+        raise ValueError("job has no fixed region")
+    objmesh.add_fixed_region(fixed)
+
+    handle = np.asarray(job['handle'], dtype=np.float64)
+    displacement = np.asarray(job['displacement'], dtype=np.float64)
+    objmesh.calc_deformable_region(handle)
+    objmesh.deform(handle, handle + displacement)
+
+    output_dir = os.path.dirname(job['output'])
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    objmesh.export_mesh(job['output'])
+    return {
+        'output': job['output'],
+        'deformed_vertices': int(objmesh.deformable_region.sum()),
+        'seconds': time.perf_counter() - start,
+    }
+
+
+def run_chunk(jobs):
+    results = []
+    for job in jobs:
+        try:
+            results.append(run_job(job))
+        except Exception as error:
+            results.append({'output': job.get('output'), 'error': repr(error)})
+    return results
+
+
+def load_jobs(path):
+    with open(path) as f:
+        jobs = json.load(f)
+    if isinstance(jobs, dict):
+        jobs = jobs['jobs']
+    base = os.path.dirname(os.path.abspath(path))
+    for job in jobs:
+        job['mesh'] = os.path.join(base, job['mesh'])
+        job['output'] = os.path.join(base, job['output'])
+    return jobs
+
+
+def make_chunks(jobs, workers, chunk_size=None):
+    """Group jobs by mesh, then split every group in chunks so that a chunk
+    only loads one mesh while all workers still get some work"""
+    groups = {}
+    for job in jobs:
+        groups.setdefault(job['mesh'], []).append(job)
+    chunks = []
+    for group in groups.values():
+        size = chunk_size or max(1, -(-len(group) // workers))
+        chunks.extend(group[i:i + size] for i in range(0, len(group), size))
+    return chunks
+
+
+def batch(jobs, workers=None, chunk_size=None):
+    workers = workers or os.cpu_count() or 1
+    chunks = make_chunks(jobs, workers, chunk_size)
+    results = []
+    if workers == 1:
+        for chunk in chunks:
+            results.extend(run_chunk(chunk))
+        return results
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(run_chunk, chunk) for chunk in chunks]
+        for future in as_completed(futures):
+            results.extend(future.result())
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m deform", description="Headless mesh deformation")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    batch_parser = subparsers.add_parser('batch', help="run the deformation jobs of a JSON file")
+    batch_parser.add_argument('jobs', help="JSON file listing the jobs")
+    batch_parser.add_argument('--workers', type=int, default=None, help="number of processes (default: CPU count)")
+    batch_parser.add_argument('--chunk-size', type=int, default=None, help="jobs sent to a process at once")
+    args = parser.parse_args(argv)
+
+    jobs = load_jobs(args.jobs)
+    start = time.perf_counter()
+    results = batch(jobs, args.workers, args.chunk_size)
+    failures = [result for result in results if 'error' in result]
+    for result in failures:
+        print(f"FAILED {result['output']}: {result['error']}", file=sys.stderr)
+    print(f"{len(results) - len(failures)}/{len(jobs)} jobs done in {time.perf_counter() - start:.2f}s")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,255 @@
+import numpy as np
+import scipy
+
+
+def build_adjacency(vertices, edges):
+    """Build a symmetric CSR adjacency matrix weighted by euclidean edge length.
+    `edges` is an (E, 2) array of unique undirected edges, such as returned
+    by unique_edges. Both directions are stored, so the graph can be
+    searched as a directed one, which spares scipy a symmetrization pass."""
+    n = len(vertices)
+    edges = np.asarray(edges)
+    lengths = np.linalg.norm(vertices[edges[:, 0]] - vertices[edges[:, 1]], axis=1)
+    rows = np.concatenate([edges[:, 0], edges[:, 1]])
+    cols = np.concatenate([edges[:, 1], edges[:, 0]])
+    data = np.concatenate([lengths, lengths])
+    return scipy.sparse.csr_matrix((data, (rows, cols)), shape=(n, n))
+
+
+def unique_edges(faces):
+    """(E, 2) array of the undirected edges of triangles, each listed once"""
+    faces = np.asarray(faces, dtype=np.int64)
+    edges = np.concatenate([faces[:, [0, 1]], faces[:, [1, 2]], faces[:, [2, 0]]])
+    edges.sort(axis=1)
+    # Sorting encoded pairs is much faster than a unique over rows
+    keys = edges[:, 0] * (int(faces.max()) + 1) + edges[:, 1]
+    keys.sort()
+    keys = keys[np.concatenate([[True], keys[1:] != keys[:-1]])]
+    return np.stack(np.divmod(keys, int(faces.max()) + 1), axis=1)
+
+
+def multi_source_dijkstra(graph, sources):
+    """Distance from every vertex to the closest of `sources`, together with
+    the index of that closest source (-1 where no source is reachable).
+    Both are obtained from a single Dijkstra pass."""
+    n = graph.shape[0]
+    sources = np.asarray(sources, dtype=np.int64)
+    if len(sources) == 0:
+        return np.full(n, np.inf), np.full(n, -1, dtype=np.int64)
+    dists, _, labels = scipy.sparse.csgraph.dijkstra(graph, directed=True, indices=sources,
+                                return_predecessors=True, min_only=True)
+    labels = labels.astype(np.int64)
+    labels[labels < 0] = -1
+    return dists, labels
+
+
+def _edges_from(graph, vertices):
+    """Start vertex and index (into graph.indices and graph.data) of every
+    edge leaving `vertices`"""
+    starts = graph.indptr[vertices]
+    counts = graph.indptr[vertices + 1] - starts
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return np.repeat(vertices, counts), np.repeat(starts, counts) + offsets
+
+
+def bounded_dijkstra(graph, source, radius):
+    """Distances from `source` to the vertices at most `radius` away, as
+    sparse (indices, distances) arrays, the search not expanding beyond the
+    radius. Also tells whether the search was cut short by the radius, that
+    is whether a reached vertex has a neighbor that was not reached."""
+    dists = scipy.sparse.csgraph.dijkstra(graph, directed=True, indices=source, limit=radius)
+    indices = np.flatnonzero(dists < np.inf)
+    _, edge = _edges_from(graph, indices)
+    truncated = bool(np.isinf(dists[graph.indices[edge]]).any())
+    return indices, dists[indices], truncated
+
+
+def dijkstra_reaching(graph, source, targets, radius):
+    """Distances from `source` as sparse (indices, distances) arrays, over a
+    ball large enough to contain every vertex of `targets` reachable from
+    it. The search starts with `radius` and doubles it until the targets
+    are reached, or until the whole connected component of the source is."""
+    targets = np.asarray(targets, dtype=np.int64)
+    while True:
+        indices, distances, truncated = bounded_dijkstra(graph, source, radius)
+        if not truncated or np.isin(targets, indices, assume_unique=True).all():
+            return indices, distances
+        radius *= 2
+
+
+def relax_from_new_sources(graph, dists, labels, sources):
+    """Update in place a multi-source distance field (`dists`, `labels`) after
+    `sources` were added to its source set.
+
+    Relaxation starts from the new sources only and proceeds in vectorized
+    Bellman-Ford rounds over the vertices whose distance just improved, so it
+    stops as soon as the new sources no longer bring anything closer."""
+    sources = np.asarray(sources, dtype=np.int64)
+    sources = np.unique(sources[dists[sources] > 0])
+    dists[sources] = 0
+    labels[sources] = sources
+
+    frontier = sources
+    while len(frontier) > 0:
+        u, edge = _edges_from(graph, frontier)
+        v = graph.indices[edge]
+        candidate = dists[u] + graph.data[edge]
+
+        improved = candidate < dists[v]
+        u, v, candidate = u[improved], v[improved], candidate[improved]
+
+        # Keep the best candidate for each improved vertex
+        order = np.lexsort((candidate, v))
+        u, v, candidate = u[order], v[order], candidate[order]
+        first = np.ones(len(v), dtype=bool)
+        first[1:] = v[1:] != v[:-1]
+        u, v, candidate = u[first], v[first], candidate[first]
+
+        dists[v] = candidate
+        labels[v] = labels[u]
+        frontier = v
+
+
+# Bound of the cotangents of the angles of triangles. Degenerate triangles
+# (e.g. with two vertices at the same position, as some meshes have) would
+# otherwise get cotangents of about 1e12, swamping every linear system built
+# on them.
+COTANGENT_LIMIT = 1e3
+
+
+def cotangents(triangles):
+    """(F, 3) cotangents of the angles at the corners of (F, 3, 3) triangles,
+    clamped to COTANGENT_LIMIT"""
+    result = np.empty(triangles.shape[:2])
+    for corner in range(3):
+        a = triangles[:, (corner + 1) % 3] - triangles[:, corner]
+        b = triangles[:, (corner + 2) % 3] - triangles[:, corner]
+        result[:, corner] = np.einsum('ij,ij->i', a, b) / np.maximum(np.linalg.norm(np.cross(a, b), axis=1), 1e-12)
+    return np.clip(result, -COTANGENT_LIMIT, COTANGENT_LIMIT)
+
+
+def cotangent_laplacian(vertices, faces):
+    """Cotangent stiffness matrix L (positive semi-definite, rows summing to
+    zero) and lumped mass matrix M (a third of the area of the faces around
+    each vertex)"""
+    n = len(vertices)
+    triangles = vertices[faces]
+    areas = 0.5 * np.linalg.norm(np.cross(triangles[:, 1] - triangles[:, 0],
+                                          triangles[:, 2] - triangles[:, 0]), axis=1)
+    corner_cotangents = cotangents(triangles)
+    rows, cols, weights = [], [], []
+    for corner in range(3):
+        # Angle at `corner`, opposite to the edge (i, j)
+        i, j = (corner + 1) % 3, (corner + 2) % 3
+        rows.append(faces[:, i])
+        cols.append(faces[:, j])
+        weights.append(0.5 * corner_cotangents[:, corner])
+    rows, cols, weights = np.concatenate(rows), np.concatenate(cols), np.concatenate(weights)
+    off_diagonal = scipy.sparse.csr_matrix((np.concatenate([-weights, -weights]),
+                                            (np.concatenate([rows, cols]), np.concatenate([cols, rows]))), shape=(n, n))
+    L = off_diagonal - scipy.sparse.diags(np.asarray(off_diagonal.sum(axis=1)).ravel())
+    M = scipy.sparse.diags(np.bincount(faces.ravel(), np.repeat(areas / 3, 3), minlength=n))
+    return L.tocsc(), M.tocsc()
+
+
+class HeatGeodesics:
+    """Geodesic distances with the heat method (Crane et al. 2013).
+
+    The heat flow and Poisson systems are factored once, so that a distance
+    query costs a back-substitution, a gradient normalization and a second
+    back-substitution. The factorization depends on the vertex positions, so
+    a new instance is needed after the mesh is deformed."""
+    def __init__(self, vertices, faces, time_factor=1.0):
+        self.vertices = np.asarray(vertices, dtype=np.float64)
+        self.faces = np.asarray(faces)
+        L, M = cotangent_laplacian(self.vertices, self.faces)
+        triangles = self.vertices[self.faces]
+        edge_length = np.linalg.norm(triangles - np.roll(triangles, 1, axis=1), axis=2).mean()
+        t = time_factor * edge_length ** 2
+        self.heat = scipy.sparse.linalg.splu((M + t * L).tocsc())
+        # L is singular (constants are in its kernel), regularize it slightly.
+        # The mass of small components would be too small to do it.
+        regularization = 1e-8 * L.diagonal().mean() * scipy.sparse.identity(len(self.vertices))
+        self.poisson = scipy.sparse.linalg.splu((L + regularization).tocsc())
+
+        # Per face quantities for the gradient and the divergence
+        self.normals = np.cross(triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0])
+        self.double_areas = np.maximum(np.linalg.norm(self.normals, axis=1), 1e-12)
+        self.normals /= self.double_areas[:, np.newaxis]
+        self.cotangents = cotangents(triangles)
+
+        n = len(self.vertices)
+        graph = scipy.sparse.csr_matrix((np.ones(3 * len(self.faces)),
+                                         (self.faces.ravel(), np.roll(self.faces, 1, axis=1).ravel())), shape=(n, n))
+        _, self.components = scipy.sparse.csgraph.connected_components(graph, directed=False)
+
+    def distances(self, sources):
+        """Approximate geodesic distance from every vertex to the closest of
+        `sources` (inf in the components of the mesh without any source)"""
+        sources = np.asarray(sources, dtype=np.int64)
+        n = len(self.vertices)
+        if len(sources) == 0:
+            return np.full(n, np.inf)
+        delta = np.zeros(n)
+        delta[sources] = 1.0
+        u = self.heat.solve(delta)
+
+        # Normalized gradient of the heat, pointing away from the sources
+        triangles = self.vertices[self.faces]
+        gradient = np.zeros((len(self.faces), 3))
+        for corner in range(3):
+            opposite = triangles[:, (corner + 2) % 3] - triangles[:, (corner + 1) % 3]
+            gradient += u[self.faces[:, corner], np.newaxis] * np.cross(self.normals, opposite)
+        gradient /= self.double_areas[:, np.newaxis]
+        norms = np.linalg.norm(gradient, axis=1, keepdims=True)
+        X = -np.divide(gradient, norms, out=np.zeros_like(gradient), where=norms > 0)
+
+        # Integrated divergence of X at each vertex
+        divergence = np.zeros(n)
+        for corner in range(3):
+            i, j, k = corner, (corner + 1) % 3, (corner + 2) % 3
+            e1 = triangles[:, j] - triangles[:, i]
+            e2 = triangles[:, k] - triangles[:, i]
+            value = 0.5 * (self.cotangents[:, k] * np.einsum('ij,ij->i', e1, X)
+                           + self.cotangents[:, j] * np.einsum('ij,ij->i', e2, X))
+            divergence += np.bincount(self.faces[:, i], value, minlength=n)
+
+        phi = self.poisson.solve(-divergence)
+        reached = np.isin(self.components, self.components[sources])
+        # Shift each component so that its closest source is at distance 0
+        shifts = np.full(self.components.max() + 1, np.inf)
+        np.minimum.at(shifts, self.components[sources], phi[sources])
+        phi = phi - shifts[self.components]
+        return np.where(reached, np.maximum(phi, 0.0), np.inf)
+
+
+def nearest_sources(graph, distances, sources):
+    """Label each vertex with the source it is closest to, from a distance
+    field only: every vertex points to its neighbor of smallest distance,
+    and these chains are followed (by pointer doubling) down to a source.
+    Chains ending at a local minimum that is not a source are labeled -1."""
+    n = len(distances)
+    sources = np.asarray(sources, dtype=np.int64)
+    degrees = np.diff(graph.indptr)
+    has_neighbors = degrees > 0
+    neighbor_distances = distances[graph.indices]
+    # First neighbor reaching the smallest distance of each row
+    smallest = np.minimum.reduceat(neighbor_distances, graph.indptr[:-1][has_neighbors])
+    candidates = np.flatnonzero(neighbor_distances == np.repeat(smallest, degrees[has_neighbors]))
+    rows = np.repeat(np.arange(n), degrees)[candidates]
+    first = np.ones(len(candidates), dtype=bool)
+    first[1:] = rows[1:] != rows[:-1]
+    closest = graph.indices[candidates[first]]
+
+    parent = np.arange(n)
+    parent[has_neighbors] = np.where(distances[closest] < distances[has_neighbors], closest, parent[has_neighbors])
+    parent[sources] = sources
+
+    while True:
+        grandparent = parent[parent]
+        if np.array_equal(grandparent, parent):
+            break
+        parent = grandparent
+    is_source = np.zeros(n, dtype=bool)
+    is_source[sources] = True
+    return np.where(is_source[parent], parent, -1)
@@ -0,0 +1,123 @@
+import numpy as np
+import moderngl
+
+from profiler import profiler
+
+
+class GPUPicker:
+    """Picking by rendering triangle indices and world positions into an
+    offscreen framebuffer, as an alternative to casting rays on the CPU.
+
+    The pass reuses the vertex and element buffers of a RenderedMesh, and is
+    restricted with a scissor to the pixel under the cursor, which is the only
+    one read back. What is picked is the center of that pixel, which CPU
+    picking also aims at (Camera.pixel_centers). It works with any moderngl context, including a headless
+    standalone one."""
+    def __init__(self, ctx, rendered_mesh):
+        self.ctx = ctx
+        self.rendered_mesh = rendered_mesh
+        self.program = ctx.program(
+            vertex_shader=open("shaders/pick.vert.glsl").read(),
+            fragment_shader=open("shaders/pick.frag.glsl").read(),
+        )
+        self.fbo = None
+        self.vao = None
+        self._vbo = None
+
+    def _framebuffer(self, size):
+        if self.fbo is not None and self.fbo.size == size:
+            return self.fbo
+        self.release_framebuffer()
+        self.fbo = self.ctx.framebuffer(
+            color_attachments=[
+                self.ctx.renderbuffer(size, components=1, dtype='i4'),
+                self.ctx.renderbuffer(size, components=4, dtype='f4'),
+            ],
+            depth_attachment=self.ctx.depth_renderbuffer(size),
+        )
+        return self.fbo
+
+    def _vertex_array(self):
+        rendered_mesh = self.rendered_mesh
+        # Buffers are reallocated when the topology of the mesh changes
+        if self.vao is None or self._vbo is not rendered_mesh.vboP:
+            if self.vao is not None:
+                self.vao.release()
+            self.vao = self.ctx.vertex_array(
+                self.program,
+                [(rendered_mesh.vboP, "3f", "in_vert")],
+                index_buffer=rendered_mesh.ibo,
+                index_element_size=4,
+            )
+            self._vbo = rendered_mesh.vboP
+        return self.vao
+
+    def pick(self, camera, x, y):
+        """Return the surface point under the screen position (x, y) and the
+        index of its face, or (None, -1) if the cursor is not over the mesh"""
+        points, faces = self.pick_many(camera, [x], [y])
+        if faces[0] < 0:
+            return None, -1
+        return points[0], int(faces[0])
+
+    @profiler.timed("gpu picking")
+    def pick_many(self, camera, xs, ys):
+        """Surface points under many screen positions, from a single pass
+        restricted to their bounding box. Returns the points (NaN where the
+        cursor is not over the mesh) and the face indices (-1 there)."""
+        width, height = camera.width, camera.height
+        # Pixels containing the positions, whose centers are sampled (rows
+        # are numbered from the bottom)
+        px = np.floor(np.asarray(xs, dtype=np.float64)).astype(np.int64)
+        py = height - 1 - np.floor(np.asarray(ys, dtype=np.float64)).astype(np.int64)
+        points = np.full((len(px), 3), np.nan)
+        faces = np.full(len(px), -1, dtype=np.int64)
+        inside = (px >= 0) & (px < width) & (py >= 0) & (py < height)
+        if not inside.any():
+            return points, faces
+        x0, y0 = px[inside].min(), py[inside].min()
+        box = (int(x0), int(y0), int(px[inside].max() - x0 + 1), int(py[inside].max() - y0 + 1))
+
+        ctx = self.ctx
+        previous_fbo = ctx.fbo
+        fbo = self._framebuffer((width, height))
+        fbo.use()
+        # Only rasterize the pixels that are read back
+        fbo.scissor = box
+        fbo.clear(0.0, 0.0, 0.0, 0.0, depth=1.0)
+        # No culling: like ray casting, back faces can be hit
+        ctx.enable_only(moderngl.DEPTH_TEST)
+        camera.set_uniforms(self.program)
+        self._vertex_array().render(moderngl.TRIANGLES)
+
+        box_faces = np.frombuffer(fbo.read(box, components=1, attachment=0, dtype='i4'), dtype=np.int32)
+        box_positions = np.frombuffer(fbo.read(box, components=4, attachment=1, dtype='f4'), dtype=np.float32)
+        fbo.scissor = None
+        if previous_fbo is not None:
+            previous_fbo.use()
+
+        # Rows of the read back box are stored bottom up
+        pixels = (py[inside] - y0) * box[2] + (px[inside] - x0)
+        faces[inside] = box_faces[pixels] - 1
+        hit = faces >= 0
+        points[hit] = box_positions.reshape(-1, 4)[pixels[hit[inside]], :3]
+        return points, faces
+
+    def release_framebuffer(self):
+        if self.fbo is not None:
+            # Standalone contexts have no default framebuffer to go back to,
+            # so the picking one may still be the current one
+            if self.ctx.fbo is self.fbo:
+                self.ctx.fbo = None
+            for attachment in self.fbo.color_attachments:
+                attachment.release()
+            self.fbo.depth_attachment.release()
+            self.fbo.release()
+            self.fbo = None
+
+    def release(self):
+        self.release_framebuffer()
+        if self.vao is not None:
+            self.vao.release()
+            self.vao = None
+        self.program.release()
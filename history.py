@@ -0,0 +1,111 @@
+"""Undo/redo of the edits of an ObjMesh.
+
+Edits are stored as deltas, never as copies of the mesh: a drag keeps the
+indices of the moved vertices and their float32 displacement, a brush stroke
+keeps the bits of the region masks before and after it, packed 8 per byte
+and limited to the range of vertices where they changed. Undoing and redoing
+apply the same delta in one direction or the other."""
+from collections import deque
+
+import numpy as np
+
+# Bytes of edits kept by default
+DEFAULT_BUDGET = 64 << 20
+
+
+class VertexDelta:
+    def __init__(self, indices, displacement):
+        self.indices = indices
+        self.displacement = displacement.astype(np.float32)
+
+    @property
+    def nbytes(self):
+        return self.indices.nbytes + self.displacement.nbytes
+
+    def apply(self, objmesh, sign):
+        objmesh.move_vertices(self.indices, sign * self.displacement)
+
+
+class MaskDelta:
+    """Bits of the boolean vertex masks (attribute name to mask) before and
+    after an edit, over the range where they changed. They are restored
+    rather than flipped back, so that the range is right even if the masks
+    were changed meanwhile by something that was not recorded."""
+    def __init__(self, before, after):
+        self.changes = {}
+        for name, mask in after.items():
+            changed = np.flatnonzero(mask != before[name])
+            if len(changed) == 0:
+                continue
+            start, stop = int(changed[0]), int(changed[-1]) + 1
+            self.changes[name] = (start, stop, np.packbits(before[name][start:stop]), np.packbits(mask[start:stop]))
+
+    @property
+    def nbytes(self):
+        return sum(before.nbytes + after.nbytes for _, _, before, after in self.changes.values())
+
+    def apply(self, objmesh, sign):
+        masks = {}
+        for name, (start, stop, before, after) in self.changes.items():
+            # Masks are replaced rather than modified, since they may be shared
+            mask = getattr(objmesh, name).copy()
+            mask[start:stop] = np.unpackbits(after if sign > 0 else before, count=stop - start).astype(bool)
+            masks[name] = mask
+        objmesh.set_regions(**masks)
+
+
+class Edit:
+    """The deltas of one user action, applied in order on redo and in reverse
+    order on undo"""
+    def __init__(self, deltas):
+        self.deltas = deltas
+
+    @property
+    def nbytes(self):
+        return sum(delta.nbytes for delta in self.deltas)
+
+    def undo(self, objmesh):
+        for delta in reversed(self.deltas):
+            delta.apply(objmesh, -1)
+
+    def redo(self, objmesh):
+        for delta in self.deltas:
+            delta.apply(objmesh, 1)
+
+
+class History:
+    """Undo and redo stacks holding at most `budget` bytes of edits, the
+    oldest edits being forgotten first"""
+    def __init__(self, budget=DEFAULT_BUDGET):
+        self.budget = budget
+        self.done = deque()
+        self.undone = []
+        self.nbytes = 0
+
+    def record(self, edit):
+        if not edit.deltas:
+            return
+        self.undone.clear()
+        self.done.append(edit)
+        self.nbytes = sum(edit.nbytes for edit in self.done)
+        while self.done and self.nbytes > self.budget:
+            self.nbytes -= self.done.popleft().nbytes
+
+    def undo(self, objmesh):
+        """Undo the latest edit, returning False if there is none"""
+        if not self.done:
+            return False
+        edit = self.done.pop()
+        self.nbytes -= edit.nbytes
+        edit.undo(objmesh)
+        self.undone.append(edit)
+        return True
+
+    def redo(self, objmesh):
+        if not self.undone:
+            return False
+        edit = self.undone.pop()
+        edit.redo(objmesh)
+        self.done.append(edit)
+        self.nbytes += edit.nbytes
+        return True
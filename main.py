@@ -1,20 +1,40 @@
+import time
+# Reference of the time to first frame, before the imports
+START_TIME = time.perf_counter()
+
+# Heavy modules are kept off the startup path, here and in the modules
+# imported below: scipy is imported as a package, which only loads its
+# submodules (sparse, spatial...) on first use, and trimesh and tkinter are
+# imported in the functions that need them
+import argparse
 import moderngl
 import struct
 import glfw
 import imgui
 import numpy as np
-import tkinter as tk
-from tkinter import filedialog
 
 from App import App
 from Camera import Camera
-from mesh import ObjMesh, RenderedMesh
+from mesh import DEFORMATION_MODES, GEODESIC_BACKENDS, ObjMesh, RenderedMesh
+from history import DEFAULT_BUDGET
+from gpu_picking import GPUPicker
+from worker import BackgroundTask
+from profiler import profiler
+from utils import resample_polyline
+
+# Distance in pixels between the brush samples along a stroke
+STROKE_SPACING = 4.0
 
 class MyApp(App):
+    def __init__(self, mesh_path, *args, history_budget=DEFAULT_BUDGET, **kwargs):
+        # Mesh loaded at startup, if any
+        self.mesh_path = mesh_path
+        # Bytes of edits kept for undo, per mesh
+        self.history_budget = history_budget
+        super().__init__(*args, **kwargs)
+
     def init(self):
         ctx = self.ctx
-        # Load a mesh
-        self.mesh = ObjMesh("sample-data/simplification.obj")
 
         # Load the glsl program
         self.program = ctx.program(
@@ -22,8 +42,14 @@ class MyApp(App):
             fragment_shader=open("shaders/mesh.frag.glsl").read(),
         )
 
-        # Create the rendered mesh from the mesh and the program
-        self.rendered_mesh = RenderedMesh(ctx, self.mesh, self.program)
+        # No mesh until one is loaded
+        self.mesh = None
+        self.rendered_mesh = None
+        # Large meshes are edited through a proxy, displayed while dragging
+        self.rendered_proxy = None
+        self.dragging = False
+        self.geodesic_backend = GEODESIC_BACKENDS[0]
+        self.deformation_mode = DEFORMATION_MODES[0]
 
         # Setup camera
         w, h = self.size()
@@ -35,21 +61,127 @@ class MyApp(App):
         self.mode = "view"  # "view", "select" or "deform"
         self.handle = None
 
-        # Initialize Tkinter for file dialog
-        self.root = tk.Tk()
-        self.root.withdraw()
+        # Brush stroke in progress: the cursor positions received since the
+        # last frame, and the last position brushed
+        self.stroke_events = []
+        self.stroke_last = None
+
+        # The deformable region is computed on a worker thread
+        self.region_task = BackgroundTask()
+
+        # Pick by rendering face indices offscreen instead of casting rays
+        self.gpu_picking = False
+
+        # Preview drags in the vertex shader, deforming the mesh on release
+        self.gpu_preview = False
+        # Handle position when the previewed drag started
+        self.preview_origin = None
+        self.picker = None
+
+        # Structures the first selection needs are built in the background
+        # once the mesh is displayed
+        self.warm_up_task = BackgroundTask()
+
+        # Tkinter, for the file dialogs, is initialized on first use
+        self.root = None
+
+        if self.mesh_path is not None:
+            self.load_mesh(self.mesh_path)
+
+    def on_first_frame(self):
+        if self.mesh is not None:
+            self.warm_up_task.submit(self.mesh.warm_up)
+
+    def file_dialog(self, save=False, **options):
+        if self.root is None:
+            import tkinter as tk
+            self.root = tk.Tk()
+            self.root.withdraw()
+        from tkinter import filedialog
+        if save:
+            return filedialog.asksaveasfilename(**options)
+        return filedialog.askopenfilename(**options)
 
     def load_mesh(self, file_path):
-        self.mesh = ObjMesh(file_path)
-        self.rendered_mesh = RenderedMesh(self.ctx, self.mesh, self.program)
+        self.region_task.cancel()
+        self.handle = None
+        self.preview_origin = None
+        self.mesh = ObjMesh(file_path, self.geodesic_backend, self.deformation_mode,
+                            history_budget=self.history_budget)
+        if self.rendered_mesh is None:
+            self.rendered_mesh = RenderedMesh(self.ctx, self.mesh, self.program)
+        else:
+            # Buffers are reused, and only reallocated if the topology changed
+            self.rendered_mesh.set_mesh(self.mesh)
+        self._show_proxy()
+        if self.first_frame_time is not None:
+            self.warm_up_task.submit(self.mesh.warm_up)
+
+    def _show_proxy(self):
+        self.dragging = False
+        if self.mesh.proxy is None:
+            if self.rendered_proxy is not None:
+                self.rendered_proxy.release()
+                self.rendered_proxy = None
+        elif self.rendered_proxy is None:
+            self.rendered_proxy = RenderedMesh(self.ctx, self.mesh.proxy, self.program)
+        else:
+            self.rendered_proxy.set_mesh(self.mesh.proxy)
+
+    def edited_mesh(self):
+        """The mesh regions are selected on and which is deformed: the proxy
+        of the loaded mesh if it has one"""
+        if self.mesh is not None and self.mesh.proxy is not None:
+            return self.mesh.proxy
+        return self.mesh
+
+    def edited_rendered_mesh(self):
+        if self.mesh.proxy is not None:
+            return self.rendered_proxy
+        return self.rendered_mesh
+
+    def refresh(self):
+        """Upload the changes of the edited mesh, mirroring the regions of
+        the proxy on the full mesh"""
+        if self.mesh.proxy is not None:
+            self.mesh.sync_proxy_regions()
+            self.rendered_proxy.update()
+        self.rendered_mesh.update()
+
+    def commit_drag(self):
+        """Apply the previewed deformation to the mesh, and the deformation
+        of the proxy to the full mesh once the drag is over"""
+        if self.preview_origin is not None:
+            rendered_mesh = self.edited_rendered_mesh()
+            rendered_mesh.handle_shift[:] = 0
+            self.edited_mesh().deform(self.preview_origin, self.handle)
+            self.preview_origin = None
+            rendered_mesh.update()
+        if not self.dragging:
+            return
+        self.dragging = False
+        self.mesh.commit_proxy()
+        self.rendered_mesh.update()
 
     def export_mesh(self, file_path):
-        self.mesh.export_mesh(file_path)
+        if self.mesh is not None:
+            self.mesh.export_mesh(file_path)
 
     def update(self, time, delta_time):
         # Update damping effect (and internal matrices)
         self.camera.update(time, delta_time)
 
+        # Apply the deformable region once the worker is done with it
+        done = self.region_task.poll()
+        if done is not None:
+            (objmesh, handle), result = done
+            if objmesh is self.edited_mesh():
+                objmesh.apply_deformable_region(result)
+                self.handle = handle
+                self.refresh()
+                if self.gpu_preview:
+                    self.edited_rendered_mesh().set_deform_weights(objmesh.current_plan())
+
     def render(self):
         ctx = self.ctx
         self.camera.set_uniforms(self.program)
@@ -57,18 +189,31 @@ class MyApp(App):
         ctx.screen.clear(1.0, 1.0, 1.0, -1.0)
 
         ctx.enable_only(moderngl.DEPTH_TEST | moderngl.CULL_FACE)
-        self.rendered_mesh.render(ctx)
+        if self.dragging:
+            self.rendered_proxy.render(ctx)
+        elif self.rendered_mesh is not None:
+            self.rendered_mesh.render(ctx)
 
     def on_key(self, key, scancode, action, mods):
         if key == glfw.KEY_ESCAPE:
             self.should_close()
         if key == glfw.KEY_R:
             self.clear_fixed_region()
+        if action == glfw.PRESS and mods & glfw.MOD_CONTROL:
+            if key == glfw.KEY_Z:
+                self.undo()
+            if key == glfw.KEY_Y:
+                self.redo()
 
     def on_mouse_move(self, x, y):
         self.camera.update_rotation(x, y)
+        if self.stroke_last is not None:
+            self.stroke_events.append((x, y))
+
+    def on_frame_mouse_move(self, x, y):
+        # Cursor events of a frame collapse into a single net handle shift
         if self.mode == "deform":
-            if glfw.get_mouse_button(self.window, glfw.MOUSE_BUTTON_RIGHT) == glfw.PRESS:
+            if self.mouse_button_held(glfw.MOUSE_BUTTON_RIGHT):
                 self.move_handle_position(x,y)
 
     def on_mouse_button(self, button, action, mods):
@@ -83,103 +228,132 @@ class MyApp(App):
                 x, y = self.mouse_pos()
                 self.select_handle(x,y)
 
+        # A brush stroke or a drag is undone as a whole
+        if button == glfw.MOUSE_BUTTON_RIGHT and self.mesh is not None:
+            if action == glfw.PRESS:
+                self.edited_mesh().begin_edit()
+            if action == glfw.RELEASE:
+                self.commit_drag()
+                self.edited_mesh().end_edit()
+                self.stroke_events = []
+                self.stroke_last = None
+
     def on_right_mouse_button_held(self):
-        x, y = self.mouse_pos()
+        if self.mode not in ("view", "select") or self.mesh is None:
+            return
+        samples = self.stroke_samples(*self.mouse_pos())
         if self.mode == "view":
-            self.select_fixed_region(x, y)
+            self.select_fixed_region(samples)
         if self.mode == "select":
-            self.select_deformable_region(x, y)
-
-    def select_fixed_region(self, x, y):
-        # global selected_vertices, vertices
-        distance_threshold = self.brush_size
-        ray_origin, ray_direction = self.camera.screen_to_world_ray(x, y)
-        objmesh = self.rendered_mesh.objmesh
-        mesh = self.rendered_mesh.objmesh.mesh
-        locations, index_ray, index_tri = mesh.ray.intersects_location(
-            ray_origins=[ray_origin],
-            ray_directions=[ray_direction]
-        )
-        if len(locations) > 0:
-            # Compute distances from the ray origin to each intersection point
-            distances = np.linalg.norm(locations - ray_origin, axis=1)
-            
-            # Get the index of the closest intersection
-            closest_index = np.argmin(distances)
-            
-            # Get the closest intersection point
-            first_intersection_point = locations[closest_index]
+            self.select_deformable_region(samples)
+
+    def stroke_samples(self, x, y):
+        """Brush positions along the path of the cursor since the previous
+        frame, so that fast strokes leave no gap"""
+        path = self.stroke_events + [(x, y)]
+        if self.stroke_last is not None:
+            path.insert(0, self.stroke_last)
+        self.stroke_events = []
+        self.stroke_last = (x, y)
+        return resample_polyline(path, STROKE_SPACING)
+
+    def pick_surfaces(self, samples):
+        """Return the intersections with the mesh of the rays under the
+        screen positions `samples` which hit it, from one batched query"""
+        if self.gpu_picking:
+            if self.picker is None:
+                self.picker = GPUPicker(self.ctx, self.rendered_mesh)
+            points, faces = self.picker.pick_many(self.camera, samples[:, 0], samples[:, 1])
         else:
+            ray_origin, ray_directions = self.camera.screen_to_world_rays(
+                *self.camera.pixel_centers(samples[:, 0], samples[:, 1]))
+            points, faces = self.rendered_mesh.objmesh.intersect_rays(ray_origin, ray_directions)
+        return points[faces >= 0]
+
+    def pick_surface(self, x, y):
+        """Return the first intersection of the ray under the cursor with the
+        mesh, or None if the ray misses it"""
+        if self.mesh is None:
+            return None
+        if self.gpu_picking:
+            if self.picker is None:
+                self.picker = GPUPicker(self.ctx, self.rendered_mesh)
+            point, _ = self.picker.pick(self.camera, x, y)
+            return point
+        # Through the center of the pixel, where GPU picking would sample
+        ray_origin, ray_direction = self.camera.screen_to_world_ray(*self.camera.pixel_centers(x, y))
+        point, _ = self.rendered_mesh.objmesh.intersect_ray(ray_origin, ray_direction)
+        return point
+
+    def brush_vertices(self, samples):
+        """Return the indices of the vertices of the edited mesh covered by
+        the brush at any of the screen positions `samples`, or None if none
+        of them is over the mesh"""
+        points = self.pick_surfaces(samples)
+        if len(points) == 0:
+            return None
+        objmesh = self.edited_mesh()
+        indices = objmesh.vertices_in_balls(points, self.brush_size)
+        if len(indices) == 0 and objmesh is not self.mesh:
+            # The proxy may have no vertex within a small brush
+            indices = objmesh.nearest_vertices(points)
+        return indices
+
+    def select_fixed_region(self, samples):
+        # The whole path of the frame is added at once, and uploaded once
+        selected_index = self.brush_vertices(samples)
+        if selected_index is None:
             return
-        vertices = mesh.vertices
-        distances = np.linalg.norm(vertices - first_intersection_point, axis=1)
-        selected_index = np.where(distances < distance_threshold)[0]
-        objmesh.add_fixed_region(selected_index)
-        self.rendered_mesh.update()
+        self.edited_mesh().add_fixed_region(selected_index)
+        self.refresh()
 
-    def select_deformable_region(self, x, y):
-        # global selected_vertices, vertices
-        distance_threshold = self.brush_size
-        ray_origin, ray_direction = self.camera.screen_to_world_ray(x, y)
-        objmesh = self.rendered_mesh.objmesh
-        mesh = self.rendered_mesh.objmesh.mesh
-        locations, index_ray, index_tri = mesh.ray.intersects_location(
-            ray_origins=[ray_origin],
-            ray_directions=[ray_direction]
-        )
-        if len(locations) > 0:
-            # Compute distances from the ray origin to each intersection point
-            distances = np.linalg.norm(locations - ray_origin, axis=1)
-            
-            # Get the index of the closest intersection
-            closest_index = np.argmin(distances)
-            
-            # Get the closest intersection point
-            first_intersection_point = locations[closest_index]
-        else:
+    def select_deformable_region(self, samples):
+        selected_index = self.brush_vertices(samples)
+        if selected_index is None:
             return
-        vertices = mesh.vertices
-        distances = np.linalg.norm(vertices - first_intersection_point, axis=1)
-        selected_index = np.where(distances < distance_threshold)[0]
-        objmesh.add_deformable_region(selected_index)
-        self.rendered_mesh.update()
-
-
+        self.edited_mesh().add_deformable_region(selected_index)
+        self.refresh()
 
     def select_handle(self, x, y):
-        # global selected_vertices, vertices
-        distance_threshold = self.brush_size
-        ray_origin, ray_direction = self.camera.screen_to_world_ray(x, y)
-        objmesh = self.rendered_mesh.objmesh
-        mesh = self.rendered_mesh.objmesh.mesh
-        locations, index_ray, index_tri = mesh.ray.intersects_location(
-            ray_origins=[ray_origin],
-            ray_directions=[ray_direction]
+        first_intersection_point = self.pick_surface(x, y)
+        if first_intersection_point is None:
+            return
+        objmesh = self.edited_mesh()
+        # The previous region keeps being displayed until the new one is
+        # ready; a newer click cancels this computation
+        self.region_task.submit(
+            objmesh.compute_deformable_region,
+            first_intersection_point,
+            objmesh.fixed_field_snapshot(),
+            context=(objmesh, first_intersection_point),
         )
-        if len(locations) > 0:
-            # Compute distances from the ray origin to each intersection point
-            distances = np.linalg.norm(locations - ray_origin, axis=1)
-            
-            # Get the index of the closest intersection
-            closest_index = np.argmin(distances)
-            
-            # Get the closest intersection point
-            first_intersection_point = locations[closest_index]
-            self.handle = first_intersection_point
-
-            self.rendered_mesh.objmesh.calc_deformable_region(self.handle)
-            self.rendered_mesh.update()
 
     def move_handle_position(self, x, y):
-        if self.handle is None:
+        # Wait for the deformation plan of the selected handle
+        if self.handle is None or self.region_task.pending:
             return
         original_position = self.handle
         ray_origin, ray_direction = self.camera.screen_to_world_ray(x, y)
         distance = np.linalg.norm(original_position - ray_origin)
         new_position = ray_origin + distance * ray_direction    # Keep the distance from the camera
         self.handle = new_position
-        self.rendered_mesh.objmesh.deform(original_position, new_position)
-        self.rendered_mesh.update()
+        objmesh = self.edited_mesh()
+        if self.gpu_preview:
+            # Only the shift uniform changes until the drag is committed
+            rendered_mesh = self.edited_rendered_mesh()
+            if self.preview_origin is None:
+                rendered_mesh.set_deform_weights(objmesh.current_plan())
+                self.preview_origin = original_position
+            rendered_mesh.handle_shift[:] = new_position - self.preview_origin
+            self.dragging = objmesh is not self.mesh
+            return
+        objmesh.deform(original_position, new_position)
+        if objmesh is self.mesh:
+            self.rendered_mesh.update()
+        else:
+            # Only the proxy follows the drag, see commit_drag
+            self.dragging = True
+            self.rendered_proxy.update()
 
     def draw_handle(self):
         if self.handle is not None:    
@@ -192,9 +366,24 @@ class MyApp(App):
 
 
 
+    def undo(self):
+        if self.mesh is not None and self.edited_mesh().undo():
+            self._history_applied()
+
+    def redo(self):
+        if self.mesh is not None and self.edited_mesh().redo():
+            self._history_applied()
+
+    def _history_applied(self):
+        if self.mesh.proxy is not None:
+            self.mesh.commit_proxy()
+        self.refresh()
+
     def clear_fixed_region(self):
-        self.rendered_mesh.objmesh.clear_fixed_region()
-        self.rendered_mesh.update()
+        if self.mesh is None:
+            return
+        self.edited_mesh().clear_fixed_region()
+        self.refresh()
 
     def on_resize(self, width, height):
         self.camera.resize(width, height)
@@ -217,10 +406,17 @@ class MyApp(App):
                     "Clear fixed region", 'R', False, True
                 )
 
+                clicked_undo, _ = imgui.menu_item("Undo", 'Ctrl+Z', False, True)
+                clicked_history_redo, _ = imgui.menu_item("Redo", 'Ctrl+Y', False, True)
+
                 if clicked_quit:
                     self.should_close()
                 if clicked_redo:
                     self.clear_fixed_region()
+                if clicked_undo:
+                    self.undo()
+                if clicked_history_redo:
+                    self.redo()
 
                 imgui.end_menu()
             imgui.end_main_menu_bar()
@@ -231,17 +427,23 @@ class MyApp(App):
 
         # Button to open file dialog and load new mesh
         if imgui.button("Load Mesh"):
-            file_path = filedialog.askopenfilename(
-                filetypes=[("OBJ files", "*.obj"), ("All files", "*.*")]
+            file_path = self.file_dialog(
+                filetypes=[("OBJ files", "*.obj"), ("Binary mesh dumps", "*.meshbin"), ("All files", "*.*")]
             )
             if file_path:
                 self.load_mesh(file_path)
 
         # Button to open file dialog and save the mesh
-        if imgui.button("Export Mesh"):
-            file_path = filedialog.asksaveasfilename(
+        if imgui.button("Export Mesh") and self.mesh is not None:
+            file_path = self.file_dialog(
+                save=True,
                 defaultextension=".obj",
-                filetypes=[("OBJ files", "*.obj"), ("All files", "*.*")]
+                filetypes=[
+                    ("OBJ files", "*.obj"),
+                    ("Binary PLY files", "*.ply"),
+                    ("Binary mesh dumps", "*.meshbin"),
+                    ("All files", "*.*"),
+                ]
             )
             if file_path:
                 self.export_mesh(file_path)
@@ -253,6 +455,38 @@ class MyApp(App):
         if self.brush_size < 0.0:
             self.brush_size = 0.0
 
+        _, self.gpu_picking = imgui.checkbox("GPU picking", self.gpu_picking)
+        _, self.gpu_preview = imgui.checkbox("GPU drag preview", self.gpu_preview)
+
+        backend = GEODESIC_BACKENDS.index(self.geodesic_backend)
+        changed, backend = imgui.combo("Geodesics", backend, GEODESIC_BACKENDS)
+        if changed:
+            self.geodesic_backend = GEODESIC_BACKENDS[backend]
+            if self.mesh is not None:
+                self.mesh.set_geodesic_backend(self.geodesic_backend)
+
+        mode = DEFORMATION_MODES.index(self.deformation_mode)
+        changed, mode = imgui.combo("Deformation", mode, DEFORMATION_MODES)
+        if changed:
+            self.deformation_mode = DEFORMATION_MODES[mode]
+            if self.mesh is not None:
+                self.mesh.set_deformation_mode(self.deformation_mode)
+
+        if self.region_task.pending:
+            imgui.progress_bar(self.region_task.progress, (0, 0), "Computing region")
+
+        _, profiler.enabled = imgui.checkbox("Profiler", profiler.enabled)
+        if profiler.enabled:
+            imgui.same_line()
+            if imgui.button("Export Trace"):
+                file_path = self.file_dialog(
+                    save=True,
+                    defaultextension=".json",
+                    filetypes=[("Chrome trace files", "*.json"), ("All files", "*.*")]
+                )
+                if file_path:
+                    profiler.export_chrome_trace(file_path)
+
         if imgui.button("View"):
             self.mode = 'view'
         if imgui.button("select"):
@@ -268,9 +502,31 @@ class MyApp(App):
 
         imgui.end()
 
+        if profiler.enabled:
+            self.profiler_overlay()
+
+    def profiler_overlay(self):
+        imgui.set_next_window_size(420, 300)
+        imgui.begin("Profiler", True)
+        imgui.text(f"{'phase':20s} {'p50':>8s} {'p95':>8s} {'p99':>8s}  (ms)")
+        for name, (p50, p95, p99) in sorted(profiler.percentiles().items()):
+            imgui.text(f"{name:20s} {p50 * 1e3:8.2f} {p95 * 1e3:8.2f} {p99 * 1e3:8.2f}")
+        imgui.end()
+
 def main():
-    app = MyApp(1280, 720, "Python 3d Mesh Deformation")
+    parser = argparse.ArgumentParser(description="Interactive mesh deformation")
+    parser.add_argument('mesh', nargs='?', default="sample-data/simplification.obj",
+                        help="mesh loaded at startup (default: %(default)s)")
+    parser.add_argument('--no-mesh', action='store_true', help="start without loading any mesh")
+    parser.add_argument('--history-mb', type=float, default=DEFAULT_BUDGET / (1 << 20),
+                        help="memory kept for undo, in MB (default: %(default)s)")
+    args = parser.parse_args()
+
+    app = MyApp(None if args.no_mesh else args.mesh, 1280, 720, "Python 3d Mesh Deformation",
+                start_time=START_TIME, history_budget=int(args.history_mb * (1 << 20)))
     app.main_loop()
+    app.region_task.shutdown()
+    app.warm_up_task.shutdown()
 
 if __name__ == "__main__":
     main()
@@ -1,177 +1,941 @@
+import threading
+
 import numpy as np
 from moderngl import TRIANGLES
-import trimesh
-from scipy.spatial import distance_matrix
-import networkx as nx
+import scipy
+
+import mesh_io
+import proxy
+from bvh import BVH
+from history import DEFAULT_BUDGET, Edit, History, MaskDelta, VertexDelta
+from profiler import profiler
+from geodesic import (HeatGeodesics, build_adjacency, cotangent_laplacian, dijkstra_reaching, multi_source_dijkstra,
+                      nearest_sources, relax_from_new_sources, unique_edges)
+
+def compute_vertex_normals(vertices, faces, vertex_count=None):
+    """Area weighted vertex normals: each face contributes its unnormalized
+    cross product to its three vertices"""
+    if vertex_count is None:
+        vertex_count = len(vertices)
+    triangles = vertices[faces]
+    face_normals = np.cross(triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0])
+    corners = faces.ravel()
+    normals = np.empty((vertex_count, 3))
+    for axis in range(3):
+        normals[:, axis] = np.bincount(corners, np.repeat(face_normals[:, axis], 3), minlength=vertex_count)
+    return normalize(normals)
+
+
+def normalize(vectors):
+    lengths = np.linalg.norm(vectors, axis=1, keepdims=True)
+    lengths[lengths == 0] = 1.0
+    return vectors / lengths
+
+
+def faces_touching(faces, mask):
+    """Mask of the faces with a vertex in the vertex mask `mask`"""
+    # Much faster than any(axis=1) over the three corners
+    corners = mask[faces]
+    return corners[:, 0] | corners[:, 1] | corners[:, 2]
+
+
+class NormalPlan:
+    """The faces whose normal changes when a set of vertices moves, and the
+    vertices whose normal must then be recomputed"""
+    def __init__(self, faces, moved):
+        vertex_count = len(moved)
+        # Faces touching a moved vertex, and the vertices of these faces
+        self.faces = np.flatnonzero(faces_touching(faces, moved))
+        around = np.zeros(vertex_count, dtype=bool)
+        around[faces[self.faces]] = True
+        self.normal_vertices = np.flatnonzero(around)
+
+        # All the faces around these vertices contribute to their normals
+        self.normal_faces = faces[faces_touching(faces, around)]
+        local = np.full(vertex_count, -1)
+        local[self.normal_vertices] = np.arange(len(self.normal_vertices))
+        corners = local[self.normal_faces]
+        self.corner_face, corner = np.nonzero(corners >= 0)
+        self.corner_vertex = corners[self.corner_face, corner]
+
+    def vertex_normals(self, vertices):
+        """Normals of `normal_vertices`, consistent with compute_vertex_normals"""
+        triangles = vertices[self.normal_faces]
+        face_normals = np.cross(triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0])
+        count = len(self.normal_vertices)
+        normals = np.empty((count, 3))
+        for axis in range(3):
+            normals[:, axis] = np.bincount(self.corner_vertex, face_normals[self.corner_face, axis], minlength=count)
+        return normalize(normals)
+
+
+def nearest_fixed_vertices(fixed_distances, fixed_nearest):
+    """Fixed vertices that are the nearest of some vertex outside of the
+    fixed region"""
+    nearest = np.zeros(len(fixed_distances), dtype=bool)
+    nearest[fixed_nearest[(fixed_distances > 0) & (fixed_nearest >= 0)]] = True
+    return np.flatnonzero(nearest)
+
+
+def closer_to_handle(handle2vertex, nearest_fixed):
+    """Vertices closer to the handle than their nearest fixed vertex is"""
+    # Vertices that cannot reach the fixed region have no nearest fixed vertex
+    handle2min = np.where(nearest_fixed >= 0, handle2vertex[nearest_fixed], np.inf)
+    return handle2vertex < handle2min
+
+
+class DeformationPlan(NormalPlan):
+    """What a drag step needs, precomputed once per deformable region: the
+    moved vertices and their weights, along with the normals to update."""
+    def __init__(self, faces, deformable_region, vertex_to_fixed_region, vertex_to_handle):
+        self.indices = np.flatnonzero(deformable_region)
+        to_fixed = vertex_to_fixed_region[self.indices]
+        to_handle = vertex_to_handle[self.indices]
+        # Vertices which cannot reach the fixed region follow the handle
+        with np.errstate(invalid='ignore'):
+            weights = np.where(np.isinf(to_fixed), 1.0, to_fixed / ((to_fixed + to_handle) + 1e-6))
+        self.weights = weights.astype(np.float32)[:, np.newaxis]
+        super().__init__(faces, deformable_region)
+
+    def displace(self, vertices, handle_shift):
+        """Move the vertices for a shift of the handle since the last step"""
+        vertices[self.indices] += self.weights * handle_shift
+
+    def vertex_weights(self, vertex_count):
+        """Fraction of the handle shift every vertex follows, for the GPU
+        preview of a drag"""
+        weights = np.zeros(vertex_count, dtype=np.float32)
+        weights[self.indices] = self.weights[:, 0]
+        return weights
+
+
+class LaplacianPlan(DeformationPlan):
+    """Laplacian surface editing over the deformable region: the region keeps
+    the cotangent Laplacian coordinates it had when the plan was made, while
+    the vertices around it stay in place and the handle (its vertex and the
+    neighbors of it inside the region) follows the drag.
+
+    The system over the free vertices is factored once, so a drag step is a
+    single back-substitution against the new handle position. The solution
+    is linear in the handle shift, so every vertex also has a weight, the
+    fraction of the shift it follows."""
+    def __init__(self, vertices, faces, graph, deformable_region, handle_index):
+        self.indices = np.flatnonzero(deformable_region)
+        NormalPlan.__init__(self, faces, deformable_region)
+        self.total_shift = np.zeros(3)
+
+        vertices = np.asarray(vertices)
+        handle = np.zeros(len(deformable_region), dtype=bool)
+        handle[handle_index] = True
+        handle[graph.indices[graph.indptr[handle_index]:graph.indptr[handle_index + 1]]] = True
+        handle &= deformable_region
+        self.handle_indices = np.flatnonzero(handle)
+        self.handle_positions = vertices[self.handle_indices]
+
+        self.free = np.flatnonzero(deformable_region & ~handle)
+        weights = handle.astype(np.float32)
+        self.weights = weights[self.indices][:, np.newaxis]
+        if len(self.free) == 0:
+            return
+        L, _ = cotangent_laplacian(vertices, faces[faces_touching(faces, deformable_region)])
+        rows = L.tocsr()[self.free]
+        # Constrained vertices the free ones depend on: the handle and the
+        # ring of vertices around the region
+        self.constrained = np.setdiff1d(np.unique(rows.indices), self.free)
+        self.constrained_positions = vertices[self.constrained]
+        self.constrained_on_handle = handle[self.constrained].astype(float)[:, np.newaxis]
+
+        self.laplacian_coordinates = rows @ vertices
+        self.coupling = rows[:, self.constrained]
+        system = rows[:, self.free]
+        # Regularized, as a part of the region may not touch any constraint
+        scale = 1e-10 * abs(system.diagonal()).mean()
+        self.solver = scipy.sparse.linalg.splu((system + scale * scipy.sparse.identity(len(self.free))).tocsc())
+        weights[self.free] = self.solver.solve(-(self.coupling @ self.constrained_on_handle[:, 0]))
+        self.weights = weights[self.indices][:, np.newaxis]
+
+    def displace(self, vertices, handle_shift):
+        self.total_shift = self.total_shift + handle_shift
+        vertices[self.handle_indices] = self.handle_positions + self.total_shift
+        if len(self.free) == 0:
+            return
+        constrained = self.constrained_positions + self.constrained_on_handle * self.total_shift
+        vertices[self.free] = self.solver.solve(self.laplacian_coordinates - self.coupling @ constrained)
+
 
 class Mesh:
-    """Simply contains an array of triangles and an array of normals.
-    Could be enhanced, for instance with an element buffer"""
-    def __init__(self, P, N, C=None):
+    """Simply contains per-vertex arrays of positions, normals and colors,
+    and an element buffer F listing the three vertex indices of each triangle"""
+    def __init__(self, P, N, C=None, F=None):
         self.P = P
         self.N = N
         self.C = C
+        self.F = F
+
+
+# Vertex color of meshes without colors, the one trimesh uses
+DEFAULT_COLOR = [102, 102, 102, 255]
+# Ways of computing geodesic distances: shortest paths along the edges, or
+# the heat method
+GEODESIC_BACKENDS = ["graph", "heat"]
+# Ways of deforming the region: distance weighted propagation of the handle
+# shift, or Laplacian surface editing
+DEFORMATION_MODES = ["propagation", "laplacian"]
+# Meshes with more vertices than this are edited through a decimated proxy of
+# about PROXY_VERTICES vertices
+PROXY_THRESHOLD = 500000
+PROXY_VERTICES = 100000
+
+
+def _cached_graph(arrays, vertex_count, prefix=""):
+    """Graph stored by ObjMesh._cached_arrays (None if it is missing, or was
+    made for another vertex count)"""
+    if prefix + 'graph_data' not in arrays or len(arrays[prefix + 'graph_indptr']) != vertex_count + 1:
+        return None
+    # Stored as float32, but scipy would convert it on every search. Indices
+    # are copied too, so that the cache file is not kept mapped.
+    return scipy.sparse.csr_matrix((np.array(arrays[prefix + 'graph_data'], dtype=np.float64),
+                                    np.array(arrays[prefix + 'graph_indices']), np.array(arrays[prefix + 'graph_indptr'])),
+                                   shape=(vertex_count, vertex_count))
 
 
 class ObjMesh(Mesh):
     """An example of mesh loader, using the pywavefront module.
     Only load the first mesh of the file if there are more than one."""
-    def __init__(self, filepath=None):
+    def __init__(self, filepath=None, geodesic_backend="graph", deformation_mode="propagation", use_proxy=None,
+                 history_budget=DEFAULT_BUDGET):
+        self.geodesic_backend = geodesic_backend
+        self.deformation_mode = deformation_mode
+        # Bytes of edits kept for undo
+        self.history_budget = history_budget
+        # None to use a proxy only above PROXY_THRESHOLD vertices
+        self.use_proxy = use_proxy
+        self.proxy = None
         if filepath is not None:
             self.load_mesh(filepath)
-        
+
+    @classmethod
+    def from_arrays(cls, vertices, faces, colors=None, **kwargs):
+        """Mesh built from arrays instead of a file, which is never cached"""
+        objmesh = cls(**kwargs)
+        objmesh._setup(vertices, faces, colors)
+        return objmesh
+
+    def to_trimesh(self):
+        """trimesh copy of the mesh, for interoperability only"""
+        import trimesh
+        return trimesh.Trimesh(self.P, self.F, vertex_colors=self.colors, process=False)
+
     def load_mesh(self,filepath):
-        mesh=trimesh.load(filepath)
-        self.mesh=mesh
-        self.fixed_region = np.zeros(len(mesh.vertices),dtype=bool)
-        self.deformable_region = np.zeros(len(mesh.vertices),dtype=bool)
-        print(f"(Object has {len(self.mesh.vertices)} points)")
-        self.create_weighted_graph()
+        # Meshes opened before are memory-mapped from their binary cache, and
+        # binary dumps are memory-mapped directly
+        if filepath.endswith(mesh_io.RAW_SUFFIX):
+            cached = mesh_io.read_arrays(filepath)
+        else:
+            cached = mesh_io.load_cache(filepath)
+        if cached is not None:
+            vertices, faces, colors = cached['vertices'], cached['faces'], cached.get('colors')
+        else:
+            import trimesh
+            mesh = trimesh.load(filepath)
+            vertices, faces, colors = mesh.vertices, mesh.faces, mesh.visual.vertex_colors
+        graph = None
+        if cached is not None:
+            graph = _cached_graph(cached, len(vertices))
+        self._setup(vertices, faces, colors, graph)
+        if cached is not None and self.proxy is not None:
+            # The proxy is not saved, but it is rebuilt the same from the mesh
+            self.proxy._graph = _cached_graph(cached, len(self.proxy.P), 'proxy_')
+        if filepath.endswith(mesh_io.RAW_SUFFIX):
+            return
+        # Key of the cache, computed once since it hashes the whole file
+        self._cache_key = None
+        loaded = {'vertices': self.P, 'faces': self.F, 'colors': self.colors}
+        if cached is None:
+            self._save_cache(filepath, loaded)
+        if self._graph is None or (self.proxy is not None and self.proxy._graph is None):
+            # The cache is completed as the graphs get built, always with the
+            # mesh as it was loaded while self.P gets deformed. Nothing of the
+            # cache file is kept mapped, as it could not be replaced on Windows.
+            loaded['vertices'] = self.P.copy()
+            self._update_cache = lambda: self._save_cache(filepath, loaded)
+            if self.proxy is not None:
+                self.proxy._update_cache = self._update_cache
+
+    def _save_cache(self, filepath, mesh_arrays):
+        """Cache `mesh_arrays` (vertices, faces and colors) for the mesh file,
+        along with the graphs built so far"""
+        arrays = dict(mesh_arrays)
+        arrays.update(self._cached_arrays())
+        if self.proxy is not None:
+            arrays.update(self.proxy._cached_arrays('proxy_'))
+        self._cache_key = mesh_io.save_cache(filepath, arrays, self._cache_key)
+
+    def _cached_arrays(self, prefix=""):
+        """Arrays of the graph, if it was built, read back by _cached_graph"""
+        arrays = {}
+        if self._graph is not None:
+            arrays.update({
+                prefix + 'graph_indptr': self._graph.indptr,
+                prefix + 'graph_indices': self._graph.indices,
+                prefix + 'graph_data': self._graph.data.astype(np.float32),
+            })
+        return arrays
+
+    def _setup(self, vertices, faces, colors=None, graph=None):
+        # Vertex attributes are contiguous float32 arrays, modified in place
+        # and uploaded as they are, and faces int32 triangles
+        vertex_count = len(vertices)
+        self.P = np.array(vertices, dtype=np.float32, order='C')
+        self.F = np.array(faces, dtype=np.int32, order='C')
+        if colors is None:
+            colors = np.tile(np.array(DEFAULT_COLOR, dtype=np.uint8), (vertex_count, 1))
+        # RGBA colors of the file, as exported
+        self.colors = np.array(colors, dtype=np.uint8, order='C')
+        self.base_colors = self.colors / np.float32(255.0)
+        self.N = np.empty((vertex_count, 3), dtype=np.float32)
+        self.N[:] = compute_vertex_normals(self.P, self.F)
+        self.C = self.base_colors.copy()
+
+        self.fixed_region = np.zeros(vertex_count,dtype=bool)
+        self.deformable_region = np.zeros(vertex_count,dtype=bool)
+        # Distance to the fixed region and closest fixed vertex, kept up to date
+        # as the fixed region grows
+        self.fixed_distances = np.full(vertex_count, np.inf)
+        self.fixed_nearest = np.full(vertex_count, -1, dtype=np.int64)
+        print(f"(Object has {vertex_count} points)")
+        # Edge-weighted vertex graph, built on first use (possibly by
+        # warm_up on another thread)
+        self._graph = graph
+        self._graph_lock = threading.Lock()
+        # Called when the graph gets built, to add it to the cache of the
+        # mesh file (None if there is no cache)
+        self._update_cache = None
+        # Spatial index over the vertices, built lazily on first query
+        self.kdtree = None
+        # Heat method factorization, built on first use and dropped whenever
+        # the vertices move
+        self.heat = None
+        # Ray picking hierarchy, built lazily and refitted over the faces
+        # moved since the last query
+        self.bvh = None
+        self.moved_faces = np.zeros(len(self.F), dtype=bool)
+
+        # Attributes that changed since the last upload, mapped to the
+        # [start, stop) range of vertices they changed in
+        self.dirty = {}
+        self.deformation_plan = None
+        self.mark_dirty('P')
+        self.mark_dirty('N')
+        self.mark_dirty('C')
         self.update_GL_variables()
+        self.history = History(self.history_budget)
+        # State of the edit in progress, between begin_edit and end_edit
+        self._edit = None
+
+        use_proxy = self.use_proxy
+        if use_proxy is None:
+            use_proxy = vertex_count > PROXY_THRESHOLD
+        if use_proxy:
+            self._build_proxy()
+
+    def _build_proxy(self):
+        """Decimated copy of the mesh on which regions are selected and
+        computed and which is deformed while dragging, the full mesh only
+        following when commit_proxy is called"""
+        with profiler.scope("proxy"):
+            vertices = self.P
+            self.proxy_clusters = proxy.cluster_vertices(vertices, PROXY_VERTICES)
+            proxy_vertices, proxy_faces = proxy.decimate(vertices, self.F, self.proxy_clusters)
+            colors = proxy.cluster_means(self.colors, self.proxy_clusters, len(proxy_vertices))
+            self.proxy = ObjMesh.from_arrays(proxy_vertices, proxy_faces, colors.round().astype(np.uint8),
+                                             geodesic_backend=self.geodesic_backend,
+                                             deformation_mode=self.deformation_mode, use_proxy=False,
+                                             history_budget=self.history_budget)
+            self.proxy_transfer = proxy.transfer_matrix(proxy_vertices, vertices)
+            # Proxy positions the full mesh currently matches
+            self.proxy_committed = self.proxy.P.copy()
+
+    def sync_proxy_regions(self):
+        """Show the regions selected on the proxy on the full mesh"""
+        clusters = self.proxy_clusters
+        fixed_region = self.proxy.fixed_region[clusters]
+        deformable_region = self.proxy.deformable_region[clusters]
+        changed = (fixed_region != self.fixed_region) | (deformable_region != self.deformable_region)
+        self.mark_dirty('C', np.flatnonzero(changed))
+        self.fixed_region = fixed_region
+        self.deformable_region = deformable_region
+
+    @profiler.timed("proxy commit")
+    def commit_proxy(self):
+        """Carry the deformation of the proxy since the last commit over to
+        the full mesh, in one sparse product"""
+        proxy_vertices = self.proxy.P
+        moved = np.flatnonzero((proxy_vertices != self.proxy_committed).any(axis=1))
+        if len(moved) == 0:
+            return
+        transfer = self.proxy_transfer[:, moved]
+        # Vertices following the moved proxy vertices, except for the fixed
+        # region which stays in place even next to them
+        moved_vertices = np.zeros(len(self.P), dtype=bool)
+        moved_vertices[transfer.indices] = True
+        moved_vertices &= ~self.fixed_region
+        indices = np.flatnonzero(moved_vertices)
+        shift = transfer[indices] @ (proxy_vertices[moved] - self.proxy_committed[moved])
+        self.proxy_committed[moved] = proxy_vertices[moved]
+
+        self.P[indices] += shift
+        self._vertices_moved(indices, NormalPlan(self.F, moved_vertices))
+
+    def _vertices_moved(self, indices, plan):
+        """Update the normals and flag what depends on the positions after
+        the vertices `indices` moved, `plan` covering these vertices"""
+        self.N[plan.normal_vertices] = plan.vertex_normals(self.P)
+        self.mark_dirty('P', indices)
+        self.mark_dirty('N', plan.normal_vertices)
+        # The spatial index and the heat factorization are rebuilt and the
+        # picking hierarchy refitted on next query
+        self.kdtree = None
+        self.heat = None
+        self.moved_faces[plan.faces] = True
+
+    def move_vertices(self, indices, displacement):
+        """Move the vertices `indices` by `displacement`, outside of a drag"""
+        self.P[indices] += displacement
+        moved = np.zeros(len(self.P), dtype=bool)
+        moved[indices] = True
+        self._vertices_moved(indices, NormalPlan(self.F, moved))
+        # Laplacian plans hold the positions they were made from
+        self.deformation_plan = None
+
+    def set_regions(self, fixed_region=None, deformable_region=None):
+        """Replace the fixed and/or the deformable region masks"""
+        if fixed_region is not None:
+            self.mark_dirty('C', np.flatnonzero(fixed_region != self.fixed_region))
+            self.fixed_region = fixed_region
+            self.fixed_distances, self.fixed_nearest = multi_source_dijkstra(self.graph, np.flatnonzero(fixed_region))
+        if deformable_region is not None:
+            self.mark_dirty('C', np.flatnonzero(deformable_region != self.deformable_region))
+            self.deformable_region = deformable_region
+        self.deformation_plan = None
+
+    def begin_edit(self):
+        """Start recording a user action (a brush stroke or a drag) for undo"""
+        self.end_edit()
+        self._edit = {
+            'masks': {'fixed_region': self.fixed_region.copy(), 'deformable_region': self.deformable_region.copy()},
+            # Plans used during the edit, with the positions of their
+            # vertices before their first step
+            'plans': [],
+            'positions': [],
+        }
+
+    def _begin_own_edit(self):
+        """Begin an edit for a change of the regions made outside of any
+        user action in progress, returning whether one was begun"""
+        if self._edit is not None:
+            return False
+        self.begin_edit()
+        return True
+
+    def end_edit(self):
+        """Record the action started by begin_edit in the history"""
+        edit, self._edit = self._edit, None
+        if edit is None:
+            return
+        deltas = []
+        masks = {'fixed_region': self.fixed_region, 'deformable_region': self.deformable_region}
+        mask_delta = MaskDelta(edit['masks'], masks)
+        if mask_delta.changes:
+            deltas.append(mask_delta)
+        if edit['plans']:
+            indices = np.concatenate([plan.indices for plan in edit['plans']])
+            positions = np.concatenate(edit['positions'])
+            # The earliest position of each vertex
+            indices, first = np.unique(indices, return_index=True)
+            displacement = self.P[indices] - positions[first]
+            moved = (displacement != 0).any(axis=1)
+            if moved.any():
+                deltas.append(VertexDelta(indices[moved], displacement[moved]))
+        self.history.record(Edit(deltas))
+
+    def undo(self):
+        """Undo the latest recorded action, returning False if there is none"""
+        self.end_edit()
+        return self.history.undo(self)
+
+    def redo(self):
+        self.end_edit()
+        return self.history.redo(self)
 
     def export_mesh(self,filepath):
-        self.mesh.export(filepath)
+        # The format is chosen from the file extension; formats without a
+        # streaming exporter go through trimesh
+        extension = filepath.lower().rsplit('.', 1)[-1]
+        if extension == 'obj':
+            # Only colors of their own are written, as trimesh did
+            colors = self.colors if (self.colors != DEFAULT_COLOR).any() else None
+            mesh_io.export_obj(filepath, self.P, self.F, self.N, colors)
+        elif extension == 'ply':
+            mesh_io.export_ply(filepath, self.P, self.F, self.colors)
+        elif filepath.endswith(mesh_io.RAW_SUFFIX):
+            mesh_io.export_raw(filepath, self.P, self.F, self.colors)
+        else:
+            self.to_trimesh().export(filepath)
 
     def create_weighted_graph(self):
-        graph = self.mesh.vertex_adjacency_graph
-        self.graph = nx.Graph()
-
-        # Add nodes to the weighted graph
-        self.graph.add_nodes_from(graph.nodes())
-
-        # Add edges with weights
-        for u, v in graph.edges():
-            distance = self.mesh.vertices[u] - self.mesh.vertices[v]
-            weight = np.linalg.norm(distance)
-            self.graph.add_edge(u, v, weight=weight)        
-
+        # CSR adjacency matrix, edges weighted by their euclidean length
+        self._graph = build_adjacency(self.P, unique_edges(self.F))
+
+    @property
+    def graph(self):
+        with self._graph_lock:
+            built = self._graph is None
+            if built:
+                with profiler.scope("graph"):
+                    self.create_weighted_graph()
+            graph = self._graph
+        # Outside of the lock, which the main thread may be waiting for
+        if built and self._update_cache is not None:
+            self._update_cache()
+        return graph
+
+    def warm_up(self, progress=None):
+        """Build the structures needed by the first selection ahead of time,
+        e.g. on a worker thread once the mesh is displayed. `progress`, if
+        given, is called with the fraction of the work done, and may raise
+        to cancel the rest."""
+        if progress is None:
+            progress = lambda fraction: None
+        self.graph
+        if self.proxy is not None:
+            progress(0.5)
+            self.proxy.warm_up(lambda fraction: progress(0.5 + 0.5 * fraction))
+        progress(1.0)
+
+    def set_vertices(self, vertices):
+        """Overwrite every vertex position, e.g. to restore the undeformed mesh"""
+        self.P[:] = vertices
+        self.N[:] = compute_vertex_normals(self.P, self.F)
+        self.mark_dirty('P')
+        self.mark_dirty('N')
+        self.kdtree = None
+        self.heat = None
+        self.moved_faces[:] = True
+        # Laplacian plans hold the positions they were made from
+        self.deformation_plan = None
+        if self.proxy is not None:
+            self.proxy.set_vertices(proxy.cluster_means(vertices, self.proxy_clusters, len(self.proxy_committed)))
+            self.proxy_committed[:] = self.proxy.P
+
+    def heat_geodesics(self):
+        """HeatGeodesics of the mesh, or None if its systems cannot be
+        factored, in which case graph distances are used instead"""
+        heat = self.heat
+        if heat is None:
+            try:
+                heat = HeatGeodesics(self.P, self.F)
+            except RuntimeError as error:
+                print(f"(Heat method unavailable on this mesh, using graph distances: {error})")
+                # Not retried until the vertices move
+                heat = False
+            self.heat = heat
+        return heat or None
+
+    def spatial_index(self):
+        if self.kdtree is None:
+            self.kdtree = scipy.spatial.cKDTree(self.P)
+        return self.kdtree
+
+    def vertices_in_ball(self, center, radius):
+        """Indices of the vertices within `radius` of `center`"""
+        indices = self.spatial_index().query_ball_point(center, radius)
+        return np.asarray(indices, dtype=np.int64)
+
+    def nearest_vertex(self, point):
+        _, index = self.spatial_index().query(point)
+        return int(index)
+
+    def nearest_vertices(self, points):
+        _, indices = self.spatial_index().query(points)
+        return np.asarray(indices, dtype=np.int64)
+
+    def vertices_in_balls(self, centers, radius):
+        """Indices of the vertices within `radius` of any of `centers`"""
+        selected = np.zeros(len(self.P), dtype=bool)
+        if len(centers) > 0:
+            for indices in self.spatial_index().query_ball_point(centers, radius):
+                selected[indices] = True
+        return np.flatnonzero(selected)
+
+    def intersect_ray(self, origin, direction):
+        """Return the closest intersection of a ray with the mesh and the index
+        of the face hit, or (None, -1) if the ray misses the mesh"""
+        points, faces = self.intersect_rays(origin, np.atleast_2d(direction))
+        if faces[0] < 0:
+            return None, -1
+        return points[0], int(faces[0])
+
+    @profiler.timed("ray picking")
+    def intersect_rays(self, origins, directions):
+        """Closest intersections of many rays with the mesh, in one query.
+        Returns the hit points (NaN on a miss) and the indices of the faces
+        hit (-1 on a miss). `origins` may be a single point shared by all
+        the rays."""
+        if self.bvh is None:
+            self.bvh = BVH(self.P, self.F)
+        elif self.moved_faces.any():
+            self.bvh.refit(self.P, np.flatnonzero(self.moved_faces))
+        self.moved_faces[:] = False
+
+        directions = np.atleast_2d(np.asarray(directions, dtype=np.float64))
+        origins = np.broadcast_to(np.asarray(origins, dtype=np.float64), directions.shape)
+        t, faces = self.bvh.intersect(self.P, origins, directions)
+        with np.errstate(invalid='ignore'):
+            points = np.where((faces >= 0)[:, np.newaxis], origins + t[:, np.newaxis] * directions, np.nan)
+        return points, faces
+
+    def mark_dirty(self, attribute, indices=None):
+        """Flag the given vertices (all of them if None) of the 'P', 'N' or
+        'C' attribute as needing a refresh and an upload"""
+        if indices is None:
+            start, stop = 0, len(self.P)
+        else:
+            indices = np.asarray(indices)
+            if len(indices) == 0:
+                return
+            start, stop = int(indices.min()), int(indices.max()) + 1
+        if attribute in self.dirty:
+            previous_start, previous_stop = self.dirty[attribute]
+            start, stop = min(start, previous_start), max(stop, previous_stop)
+        self.dirty[attribute] = (start, stop)
+
+    def pop_dirty(self):
+        """Return the dirty ranges and consider them uploaded"""
+        dirty, self.dirty = self.dirty, {}
+        return dirty
 
     def update_GL_variables(self):
-        vertices = self.mesh.vertices
-        faces = self.mesh.faces
-        normals = self.mesh.vertex_normals
-        colors = self.mesh.visual.vertex_colors.copy()
-        colors[self.deformable_region] = [0,0,255,255]
-        colors[self.fixed_region] = [255,0,0,255]
-
-        self.P = vertices[faces.flatten()]
-        self.N = normals[faces.flatten()]
-        self.C = colors[faces.flatten()] / 255.0
-
+        # Positions and normals are updated in place by deform, so only the
+        # colors are refreshed here
+        if 'C' in self.dirty:
+            start, stop = self.dirty['C']
+            colors = self.base_colors[start:stop].copy()
+            colors[self.deformable_region[start:stop]] = [0,0,1,1]
+            colors[self.fixed_region[start:stop]] = [1,0,0,1]
+            self.C[start:stop] = colors
+
+    @profiler.timed("fixed region field")
     def add_fixed_region(self,indices):
+        indices = np.asarray(indices, dtype=np.int64)
+        new_indices = indices[~self.fixed_region[indices]]
+        if len(new_indices) > 0:
+            if self.fixed_region.any():
+                relax_from_new_sources(self.graph, self.fixed_distances, self.fixed_nearest, new_indices)
+            else:
+                self.fixed_distances, self.fixed_nearest = multi_source_dijkstra(self.graph, new_indices)
         self.fixed_region[indices] = True
+        self.mark_dirty('C', new_indices)
         self.clear_deformable_region()
 
     def add_deformable_region(self,indices):
         self.deformable_region[indices] = True
+        self.mark_dirty('C', indices)
+        self.deformation_plan = None
 
     def clear_fixed_region(self):
+        recording = self._begin_own_edit()
+        self.mark_dirty('C', np.flatnonzero(self.fixed_region))
         self.fixed_region = np.zeros_like(self.fixed_region)
+        self.fixed_distances.fill(np.inf)
+        self.fixed_nearest.fill(-1)
         self.clear_deformable_region()
+        if recording:
+            self.end_edit()
 
     def clear_deformable_region(self):
+        self.mark_dirty('C', np.flatnonzero(self.deformable_region))
         self.deformable_region = np.zeros_like(self.deformable_region)
+        self.deformation_plan = None
 
     def calc_deformable_region(self,handle):
-        min_dists,min_indices = self._geodestic_distances_from_fixed_region()
-
-        handle_distances = np.linalg.norm(self.mesh.vertices - handle, axis=1)
-        handle_index = np.argmin(handle_distances)
-
-        handle_path_lengths = nx.single_source_dijkstra_path_length(self.graph, source=handle_index, weight='weight')
-
-        handle2vertex = np.array([handle_path_lengths.get(j, np.inf) for j in range(len(self.mesh.vertices))])
-        handle2min = handle2vertex[min_indices]
-        self.deformable_region = (handle2vertex < handle2min)
-
-        self.distance_info = {
+        self.apply_deformable_region(self.compute_deformable_region(handle))
+
+    def compute_deformable_region(self, handle, fixed_field=None, progress=None):
+        """Compute the deformable region for a handle without modifying the
+        mesh, so that it can run on a worker thread. `fixed_field` is a
+        snapshot from fixed_field_snapshot, taken by the caller if the fixed
+        region may change meanwhile. `progress`, if given, is called with
+        the fraction of the work done between stages."""
+        if progress is None:
+            progress = lambda fraction: None
+        if not isinstance(fixed_field, tuple):
+            # Distances to compute, from the fixed vertices if given
+            fixed_field = self._geodestic_distances_from_fixed_region(fixed_field)
+        min_dists,min_indices = fixed_field
+
+        handle_index = self.nearest_vertex(handle)
+        progress(0.1)
+
+        heat = self.heat_geodesics() if self.geodesic_backend == "heat" else None
+        if heat is not None:
+            with profiler.scope("heat method"):
+                handle2vertex = heat.distances([handle_index])
+            deformable_region = closer_to_handle(handle2vertex, min_indices)
+        else:
+            with profiler.scope("dijkstra"):
+                handle2vertex = self._distances_from_handle(handle_index, fixed_field)
+            deformable_region = closer_to_handle(handle2vertex, min_indices)
+        progress(0.6)
+
+        distance_info = {
             'vertex_to_fixed_region': min_dists,
             'vertex_to_handle': handle2vertex,
+            'handle_index': handle_index,
         }
+        progress(0.7)
+        plan = self._plan_deformation(deformable_region, distance_info)
+        progress(1.0)
+        return deformable_region, distance_info, plan
+
+    def _distances_from_handle(self, handle_index, fixed_field):
+        """Graph distances from the handle, searched only as far as needed
+        to tell which vertices are deformable (inf beyond).
+
+        A vertex is deformable if it is closer to the handle than its nearest
+        fixed vertex is, so once the search has reached every fixed vertex
+        that is the nearest of some other vertex, the vertices left are not
+        deformable. All those fixed vertices are at least as far as the
+        fixed region is from the handle, which gives the initial radius."""
+        min_dists, min_indices = fixed_field
+        targets = nearest_fixed_vertices(min_dists, min_indices)
+        radius = 2 * min_dists[handle_index]
+        if len(targets) == 0:
+            radius = np.inf
+        elif radius == 0:
+            radius = self.graph.data.max()
+        indices, distances = dijkstra_reaching(self.graph, handle_index, targets, radius)
+        handle2vertex = np.full(len(min_dists), np.inf)
+        handle2vertex[indices] = distances
+        return handle2vertex
+
+    def apply_deformable_region(self, result):
+        """Make a result of compute_deformable_region the current region"""
+        recording = self._begin_own_edit()
+        deformable_region, self.distance_info, self.deformation_plan = result
+        self.mark_dirty('C', np.flatnonzero(deformable_region != self.deformable_region))
+        self.deformable_region = deformable_region
+        if recording:
+            self.end_edit()
+
+    def _plan_deformation(self, deformable_region=None, distance_info=None):
+        if deformable_region is None:
+            deformable_region, distance_info = self.deformable_region, self.distance_info
+        if self.deformation_mode == "laplacian":
+            return LaplacianPlan(self.P, self.F, self.graph,
+                                 deformable_region, distance_info['handle_index'])
+        return DeformationPlan(
+            self.F,
+            deformable_region,
+            distance_info['vertex_to_fixed_region'],
+            distance_info['vertex_to_handle'],
+        )
 
+    def set_deformation_mode(self, mode):
+        self.deformation_mode = mode
+        # Rebuilt for the new mode on the next drag
+        self.deformation_plan = None
+        if self.proxy is not None:
+            self.proxy.set_deformation_mode(mode)
+
+    def set_geodesic_backend(self, backend):
+        self.geodesic_backend = backend
+        if self.proxy is not None:
+            self.proxy.geodesic_backend = backend
+
+    def current_plan(self):
+        # The plan is rebuilt if the region was edited with the brush
+        if self.deformation_plan is None:
+            self._extend_handle_distances()
+            self.deformation_plan = self._plan_deformation()
+        return self.deformation_plan
+
+    def _extend_handle_distances(self):
+        """Search the handle distances of the vertices brushed into the
+        deformable region beyond the bounded search of _distances_from_handle,
+        which would otherwise get no weight"""
+        to_handle = self.distance_info['vertex_to_handle']
+        painted = np.flatnonzero(self.deformable_region & np.isinf(to_handle))
+        if len(painted) == 0:
+            return
+        reached = to_handle[np.isfinite(to_handle)]
+        radius = reached.max() if len(reached) > 0 and reached.max() > 0 else self.graph.data.max()
+        with profiler.scope("dijkstra"):
+            indices, distances = dijkstra_reaching(self.graph, self.distance_info['handle_index'], painted, radius)
+        # Copied, since the result of compute_deformable_region may be shared
+        to_handle = to_handle.copy()
+        to_handle[indices] = distances
+        self.distance_info = dict(self.distance_info, vertex_to_handle=to_handle)
+
+    @profiler.timed("deform")
     def deform(self,handle_original_position,handle_new_position):
-        vertex_to_fixed_region = self.distance_info['vertex_to_fixed_region']
-        vertex_to_handle = self.distance_info['vertex_to_handle']
-
-        weight = vertex_to_fixed_region/((vertex_to_fixed_region + vertex_to_handle) + 1e-6)
+        plan = self.current_plan()
 
         handle_shift = handle_new_position - handle_original_position
 
-        self.mesh.vertices[self.deformable_region] += weight[self.deformable_region][:,np.newaxis] * handle_shift
-
-        # Update the OpenGL variables
-        self.update_GL_variables()
+        vertices = self.P
+        edit = self._edit
+        if edit is not None and not any(plan is recorded for recorded in edit['plans']):
+            edit['plans'].append(plan)
+            edit['positions'].append(vertices[plan.indices].copy())
+        plan.displace(vertices, handle_shift)
+        self._vertices_moved(plan.indices, plan)
 
     def _euclidean_distances_from_fixed_region(self):
-        vertices = self.mesh.vertices
+        vertices = self.P
         fixed_region_indices = np.where(self.fixed_region)[0]
         fixed_region_vertices = vertices[self.fixed_region]
-        dists = distance_matrix(vertices, fixed_region_vertices)
+        dists = scipy.spatial.distance_matrix(vertices, fixed_region_vertices)
         min_dists = np.min(dists, axis=1)
         min_indices = fixed_region_indices[np.argmin(dists, axis=1)]
         return min_dists,min_indices
         
-    def _geodestic_distances_from_fixed_region(self):
-        # Create the adjacency graph of the mesh
-        weighted_graph = self.graph.copy()
-        
-        fixed_region_indices = np.where(self.fixed_region)[0]
-        virtual_source = 'virtual_source'
-        weighted_graph.add_node(virtual_source)
-
-        for index in fixed_region_indices:
-            weighted_graph.add_edge(virtual_source,index,weight=0)
-
-        shortest_path_details = nx.single_source_dijkstra_path(weighted_graph, source=virtual_source, weight='weight')
-        shortest_path_lengths = nx.single_source_dijkstra_path_length(weighted_graph, source=virtual_source, weight='weight')
-
-        min_dists = np.array([shortest_path_lengths.get(j, np.inf) for j in range(len(self.mesh.vertices))])
-        min_indices = np.zeros(len(self.mesh.vertices),dtype=int)
-
-        for index,shortest_path in shortest_path_details.items():
-            if index != virtual_source:
-                min_indices[index] = shortest_path[1]
-        return min_dists,min_indices
+    def fixed_field_snapshot(self):
+        """Copy of the fixed-region distances and nearest fixed vertices, for
+        compute_deformable_region to use on another thread. With the heat
+        method, which computes them on demand, the indices of the fixed
+        vertices instead."""
+        if self.geodesic_backend == "heat":
+            return np.flatnonzero(self.fixed_region)
+        return self._geodestic_distances_from_fixed_region()
+
+    def _geodestic_distances_from_fixed_region(self, fixed_region_indices=None):
+        # Only snapshots taken for the heat method give the fixed vertices
+        heat = self.heat_geodesics() if self.geodesic_backend == "heat" else None
+        if heat is not None:
+            if fixed_region_indices is None:
+                fixed_region_indices = np.flatnonzero(self.fixed_region)
+            with profiler.scope("heat method"):
+                min_dists = heat.distances(fixed_region_indices)
+            min_indices = nearest_sources(self.graph, min_dists, fixed_region_indices)
+            return min_dists,min_indices
+        if fixed_region_indices is not None:
+            # The heat method turned out to be unavailable
+            return multi_source_dijkstra(self.graph, fixed_region_indices)
+        # The field is maintained incrementally by add_fixed_region, so this is
+        # only a lookup. Copies are returned since the field keeps changing.
+        return self.fixed_distances.copy(), self.fixed_nearest.copy()
 
 class RenderedMesh:
     """The equivalent of a Mesh, but stored in OpenGL buffers (on the GPU)
-    ready to be rendered."""
-    def __init__(self, ctx, objmesh, program):
+    ready to be rendered.
+
+    In indexed mode (the default) vertex attributes are stored once per vertex
+    and triangles are drawn through an element buffer. Otherwise attributes are
+    expanded per face corner. Buffers are allocated once per topology and then
+    overwritten in place.
+
+    A drag can also be previewed on the GPU: the weights of a deformation
+    plan are uploaded once, and the vertex shader moves every vertex by its
+    weight times `handle_shift`, which the drag updates."""
+    def __init__(self, ctx, objmesh, program, indexed=True):
         self.objmesh = objmesh
         self.ctx = ctx
         self.program = program
+        self.indexed = indexed
+        self.vao = None
+        self._topology = None
+        self.handle_shift = np.zeros(3, dtype=np.float32)
         self.update()
-        # self.vboP = ctx.buffer(mesh.P.astype('f4').tobytes())
-        # self.vboN = ctx.buffer(mesh.N.astype('f4').tobytes())
-        # self.vboC = ctx.buffer(mesh.C.astype('f4').tobytes())
-        # self.vao = ctx.vertex_array(
-        #     program,
-        #     [
-        #         (self.vboP, "3f", "in_vert"),
-        #         (self.vboN, "3f", "in_normal"),
-        #         (self.vboC, "4f", "in_color"),
-        #     ]
-        # )
-    
+
+    def set_mesh(self, objmesh):
+        self.objmesh = objmesh
+        self.handle_shift[:] = 0
+        self.update()
+
+    @profiler.timed("gpu upload")
     def update(self):
         self.objmesh.update_GL_variables()
-        self.vboP = self.ctx.buffer(self.objmesh.P.astype('f4').tobytes())
-        self.vboN = self.ctx.buffer(self.objmesh.N.astype('f4').tobytes())
-        self.vboC = self.ctx.buffer(self.objmesh.C.astype('f4').tobytes())
+        dirty = self.objmesh.pop_dirty()
+        if self._topology is not self.objmesh.F or len(self.objmesh.P) != self.vertex_count:
+            self._allocate(*self._attributes())
+            return
+        # Only upload the attribute streams and vertex ranges that changed
+        buffers = {'P': self.vboP, 'N': self.vboN, 'C': self.vboC}
+        for attribute, (start, stop) in dirty.items():
+            data = getattr(self.objmesh, attribute)
+            if self.indexed:
+                offset = start
+                chunk = data[start:stop]
+            else:
+                # Range of face corners referencing the dirty vertices
+                corners = self.objmesh.F.ravel()
+                selected = np.flatnonzero((corners >= start) & (corners < stop))
+                if len(selected) == 0:
+                    continue
+                offset = selected[0]
+                chunk = data[corners[offset:selected[-1] + 1]]
+            buffer = buffers[attribute]
+            stride = buffer.size // self.element_count
+            # Slices of the float32 attributes are uploaded without a copy
+            buffer.write(np.ascontiguousarray(chunk, dtype='f4'), offset=int(offset) * stride)
+
+    def set_deform_weights(self, plan):
+        """Upload the vertex weights of a deformation plan, unless they are
+        the ones in use already"""
+        if plan is self._weights_plan:
+            return
+        weights = plan.vertex_weights(self.vertex_count)
+        if not self.indexed:
+            weights = weights[self.objmesh.F.ravel()]
+        self.vboW.write(weights)
+        self._weights_plan = plan
+
+    def _attributes(self):
+        objmesh = self.objmesh
+        if self.indexed:
+            return objmesh.P, objmesh.N, objmesh.C
+        corners = objmesh.F.ravel()
+        return objmesh.P[corners], objmesh.N[corners], objmesh.C[corners]
+
+    def _allocate(self, P, N, C):
+        if self.vao is not None:
+            self.release()
+        self.vboP = self.ctx.buffer(np.ascontiguousarray(P, dtype='f4'))
+        self.vboN = self.ctx.buffer(np.ascontiguousarray(N, dtype='f4'))
+        self.vboC = self.ctx.buffer(np.ascontiguousarray(C, dtype='f4'))
+        self.vboW = self.ctx.buffer(np.zeros(len(P), dtype='f4'))
+        self._weights_plan = None
+        self.ibo = None
+        if self.indexed:
+            self.ibo = self.ctx.buffer(np.ascontiguousarray(self.objmesh.F, dtype='i4'))
         self.vao = self.ctx.vertex_array(
             self.program,
             [
                 (self.vboP, "3f", "in_vert"),
                 (self.vboN, "3f", "in_normal"),
                 (self.vboC, "4f", "in_color"),
-            ]
+            ] + ([(self.vboW, "1f", "in_weight")] if "in_weight" in self.program else []),
+            index_buffer=self.ibo,
+            index_element_size=4,
         )
+        self._topology = self.objmesh.F
+        self.vertex_count = len(self.objmesh.P)
+        # Number of elements stored in each attribute buffer
+        self.element_count = len(P)
 
     def release(self):
         self.vboP.release()
         self.vboN.release()
         self.vboC.release()
+        self.vboW.release()
+        if self.ibo is not None:
+            self.ibo.release()
         self.vao.release()
+        self.vao = None
+        self._topology = None
 
     def render(self, ctx):
+        if "uHandleShift" in self.program:
+            self.program["uHandleShift"].value = tuple(self.handle_shift)
         self.vao.render(TRIANGLES)
@@ -0,0 +1,210 @@
+"""Binary mesh storage.
+
+Arrays are stored in a simple container: an 8 byte magic, the length of a
+JSON header, the header itself (dtype, shape and offset of every array, plus
+an optional key), then the raw arrays, each aligned on 64 bytes so that they
+can be memory-mapped."""
+import hashlib
+import json
+import os
+import struct
+import uuid
+
+import numpy as np
+
+MAGIC = b"MESHBIN1"
+ALIGNMENT = 64
+CACHE_SUFFIX = ".meshcache"
+
+
+def _align(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def write_arrays(path, arrays, key=None):
+    """Write a dict of arrays to `path`. The file is written next to its
+    destination first, under a name of its own so that concurrent writers
+    do not collide, then moved, so readers never see a partial file."""
+    arrays = {name: np.ascontiguousarray(array) for name, array in arrays.items()}
+    # Offsets are relative to the end of the header, whose length depends on them
+    entries = {}
+    offset = 0
+    for name, array in arrays.items():
+        entries[name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+        offset = _align(offset + array.nbytes)
+    header = json.dumps({'key': key, 'arrays': entries}).encode()
+    data_start = _align(len(MAGIC) + 8 + len(header))
+
+    # A random name rather than mkstemp, whose files are private to the user
+    temporary_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    f = open(temporary_path, 'xb')
+    try:
+        with f:
+            f.write(MAGIC)
+            f.write(struct.pack('<Q', len(header)))
+            f.write(header)
+            for name, array in arrays.items():
+                f.seek(data_start + entries[name]['offset'])
+                f.write(memoryview(array).cast('B'))
+            f.truncate(data_start + offset)
+        os.replace(temporary_path, path)
+    except BaseException:
+        os.unlink(temporary_path)
+        raise
+
+
+def read_header(path):
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a binary mesh file")
+        header_size, = struct.unpack('<Q', f.read(8))
+        header = json.loads(f.read(header_size))
+    header['data_start'] = _align(len(MAGIC) + 8 + header_size)
+    return header
+
+
+def read_arrays(path, header=None):
+    """Memory-map the arrays of a file written by write_arrays (read only)"""
+    if header is None:
+        header = read_header(path)
+    arrays = {}
+    for name, entry in header['arrays'].items():
+        shape = tuple(entry['shape'])
+        if np.prod(shape) == 0:
+            arrays[name] = np.zeros(shape, dtype=entry['dtype'])
+            continue
+        arrays[name] = np.memmap(path, dtype=entry['dtype'], mode='r',
+                                 offset=header['data_start'] + entry['offset'], shape=shape)
+    return arrays
+
+
+def content_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def file_key(path):
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'hash': content_hash(path)}
+
+
+def load_cache(path):
+    """Arrays cached for the mesh file `path`, or None if there is no valid
+    cache. The cache is valid if the size and modification time of the file
+    match, or failing that if its content hash does."""
+    cache_path = path + CACHE_SUFFIX
+    try:
+        header = read_header(cache_path)
+        stat = os.stat(path)
+    except (OSError, ValueError):
+        return None
+    key = header['key']
+    if key is None or key['size'] != stat.st_size:
+        return None
+    if key['mtime'] != stat.st_mtime_ns and key['hash'] != content_hash(path):
+        return None
+    return read_arrays(cache_path, header)
+
+
+def save_cache(path, arrays, key=None):
+    """Cache arrays for the mesh file `path` in a sidecar file, returning the
+    key of the file, which can be given back to save hashing it again on the
+    next save (None if it could not be computed). Failing to write the cache
+    (e.g. in a read-only directory) is not an error."""
+    try:
+        if key is None:
+            key = file_key(path)
+        write_arrays(path + CACHE_SUFFIX, arrays, key=key)
+    except OSError as error:
+        print(f"(Could not write mesh cache: {error})")
+    return key
+
+
+# Binary dump of a mesh, readable back with read_arrays
+RAW_SUFFIX = ".meshbin"
+# Number of vertices or faces formatted and written at once
+CHUNK_SIZE = 1 << 16
+
+
+def _write_chunked(f, template, rows, transform=None):
+    """Write every row of a 2D array formatted with `template`, one chunk at a
+    time so that the text of the whole array is never held in memory. `rows`
+    can also be a tuple of 2D arrays, whose rows are written side by side."""
+    if not isinstance(rows, tuple):
+        rows = (rows,)
+    for start in range(0, len(rows[0]), CHUNK_SIZE):
+        chunk = np.hstack([np.asarray(array[start:start + CHUNK_SIZE]) for array in rows])
+        if transform is not None:
+            chunk = transform(chunk)
+        f.write((template * len(chunk)) % tuple(chunk.ravel().tolist()))
+
+
+def export_obj(path, vertices, faces, normals=None, colors=None):
+    """OBJ with optional vertex normals, and RGB(A) uint8 vertex colors written
+    after the positions as values in [0, 1], as trimesh does"""
+    with open(path, 'w') as f:
+        if colors is not None:
+            _write_chunked(f, "v %.8f %.8f %.8f %.8f %.8f %.8f\n", (vertices, colors[:, :3]),
+                           lambda chunk: chunk * np.array([1, 1, 1, 1 / 255, 1 / 255, 1 / 255]))
+        else:
+            _write_chunked(f, "v %.8f %.8f %.8f\n", vertices)
+        if normals is not None:
+            _write_chunked(f, "vn %.8f %.8f %.8f\n", normals)
+            # OBJ indices start at 1, and each vertex uses the normal of same index
+            _write_chunked(f, "f %d//%d %d//%d %d//%d\n", faces,
+                           lambda chunk: np.repeat(chunk + 1, 2, axis=1))
+        else:
+            _write_chunked(f, "f %d %d %d\n", faces, lambda chunk: chunk + 1)
+
+
+def export_ply(path, vertices, faces, colors=None):
+    """Binary little endian PLY, with optional RGBA uint8 vertex colors"""
+    vertex_fields = [('x', '<f4'), ('y', '<f4'), ('z', '<f4')]
+    header = [
+        "ply",
+        "format binary_little_endian 1.0",
+        f"element vertex {len(vertices)}",
+        "property float x",
+        "property float y",
+        "property float z",
+    ]
+    if colors is not None:
+        vertex_fields += [('red', 'u1'), ('green', 'u1'), ('blue', 'u1'), ('alpha', 'u1')]
+        header += ["property uchar red", "property uchar green", "property uchar blue", "property uchar alpha"]
+    header += [
+        f"element face {len(faces)}",
+        "property list uchar int vertex_indices",
+        "end_header",
+    ]
+    vertex_dtype = np.dtype(vertex_fields)
+    face_dtype = np.dtype([('count', 'u1'), ('indices', '<i4', (3,))])
+
+    with open(path, 'wb') as f:
+        f.write(("\n".join(header) + "\n").encode('ascii'))
+        for start in range(0, len(vertices), CHUNK_SIZE):
+            stop = min(start + CHUNK_SIZE, len(vertices))
+            chunk = np.empty(stop - start, dtype=vertex_dtype)
+            chunk['x'], chunk['y'], chunk['z'] = np.asarray(vertices[start:stop]).T
+            if colors is not None:
+                chunk['red'], chunk['green'], chunk['blue'], chunk['alpha'] = np.asarray(colors[start:stop]).T
+            chunk.tofile(f)
+        for start in range(0, len(faces), CHUNK_SIZE):
+            stop = min(start + CHUNK_SIZE, len(faces))
+            chunk = np.empty(stop - start, dtype=face_dtype)
+            chunk['count'] = 3
+            chunk['indices'] = faces[start:stop]
+            chunk.tofile(f)
+
+
+def export_raw(path, vertices, faces, colors=None):
+    """float32 vertices and int32 faces, in the container of write_arrays"""
+    arrays = {
+        'vertices': np.asarray(vertices, dtype=np.float32),
+        'faces': np.asarray(faces, dtype=np.int32),
+    }
+    if colors is not None:
+        arrays['colors'] = np.asarray(colors, dtype=np.uint8)
+    write_arrays(path, arrays)
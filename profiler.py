@@ -0,0 +1,128 @@
+"""Low overhead timing of the phases of a frame.
+
+Code to be timed is wrapped in `with profiler.scope("name"):`, or decorated
+with `@profiler.timed("name")`. While the profiler is disabled, scope returns
+a shared no-op context manager and timed functions are called directly, so
+the instrumentation only costs a function call. Once enabled, every scope is
+recorded in fixed-size ring buffers, from which rolling percentiles are
+computed and which can be exported as a Chrome trace (chrome://tracing or
+https://ui.perfetto.dev)."""
+import functools
+import json
+import threading
+import time
+
+import numpy as np
+
+
+class _NullScope:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_SCOPE = _NullScope()
+
+
+class _Scope:
+    __slots__ = ('profiler', 'name', 'start')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler.record(self.name, self.start, time.perf_counter() - self.start)
+        return False
+
+
+class Profiler:
+    def __init__(self, capacity=1 << 16):
+        self.enabled = False
+        self.capacity = capacity
+        self.names = []
+        self._name_ids = {}
+        self._name = np.zeros(capacity, dtype=np.int32)
+        self._start = np.zeros(capacity)
+        self._duration = np.zeros(capacity)
+        self._thread = np.zeros(capacity, dtype=np.int64)
+        # Number of scopes recorded so far, the latest ones being kept
+        self.count = 0
+        self.origin = time.perf_counter()
+
+    def scope(self, name):
+        if not self.enabled:
+            return _NULL_SCOPE
+        return _Scope(self, name)
+
+    def timed(self, name):
+        """Decorator recording every call of a function as a scope"""
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return function(*args, **kwargs)
+                with _Scope(self, name):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def record(self, name, start, duration):
+        name_id = self._name_ids.get(name)
+        if name_id is None:
+            name_id = self._name_ids[name] = len(self.names)
+            self.names.append(name)
+        i = self.count % self.capacity
+        self.count += 1
+        self._name[i] = name_id
+        self._start[i] = start
+        self._duration[i] = duration
+        self._thread[i] = threading.get_ident()
+
+    def clear(self):
+        self.count = 0
+
+    def _recorded(self, last=None):
+        """Indices of the recorded scopes, oldest first"""
+        size = min(self.count, self.capacity)
+        if last is not None:
+            size = min(size, last)
+        return (self.count - size + np.arange(size)) % self.capacity
+
+    def percentiles(self, q=(50, 95, 99), last=4096):
+        """Percentiles of the durations (in seconds) of each scope name, over
+        the `last` recorded scopes"""
+        indices = self._recorded(last)
+        names = self._name[indices]
+        durations = self._duration[indices]
+        stats = {}
+        for name_id in np.unique(names):
+            stats[self.names[name_id]] = np.percentile(durations[names == name_id], q)
+        return stats
+
+    def export_chrome_trace(self, path):
+        indices = self._recorded()
+        threads = {thread: tid for tid, thread in enumerate(np.unique(self._thread[indices]))}
+        events = [
+            {
+                'name': self.names[self._name[i]],
+                'ph': 'X',
+                'ts': (self._start[i] - self.origin) * 1e6,
+                'dur': self._duration[i] * 1e6,
+                'pid': 0,
+                'tid': threads[self._thread[i]],
+            }
+            for i in indices
+        ]
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+# Profiler shared by the application and the mesh code
+profiler = Profiler()
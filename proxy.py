@@ -0,0 +1,71 @@
+"""Decimated stand-in of a large mesh, deformed interactively in its place.
+
+The proxy is obtained by vertex clustering: the vertices falling in the same
+cell of a regular grid become a single proxy vertex, at their mean position.
+Displacements of the proxy are carried over to the full resolution mesh by a
+sparse transfer matrix, each vertex following its nearest proxy vertices
+weighted by inverse distance."""
+import numpy as np
+import scipy
+
+
+def cluster_vertices(vertices, target_count):
+    """Index of the grid cell of every vertex (numbered from 0), for a grid
+    sized so that about `target_count` cells are occupied"""
+    vertices = np.asarray(vertices)
+    low = vertices.min(axis=0)
+    extent = np.maximum(vertices.max(axis=0) - low, 1e-12)
+    # A surface occupies a number of cells inversely proportional to the
+    # square of their size, which gives the correction of the first guess
+    cell = extent.max() / np.sqrt(target_count)
+    for _ in range(2):
+        clusters, count = _grid_cells(vertices, low, extent, cell)
+        cell *= np.sqrt(count / target_count)
+    return _grid_cells(vertices, low, extent, cell)[0]
+
+
+def _grid_cells(vertices, low, extent, cell):
+    shape = (extent // cell).astype(np.int64) + 1
+    coordinates = ((vertices - low) // cell).astype(np.int64)
+    keys = (coordinates[:, 0] * shape[1] + coordinates[:, 1]) * shape[2] + coordinates[:, 2]
+    _, clusters = np.unique(keys, return_inverse=True)
+    clusters = clusters.ravel()
+    return clusters, int(clusters.max()) + 1
+
+
+def decimate(vertices, faces, clusters):
+    """Proxy vertices and faces for a clustering of the vertices. Faces
+    collapsing to an edge or a point are dropped, as are duplicates."""
+    proxy_vertices = cluster_means(vertices, clusters, int(clusters.max()) + 1)
+    proxy_faces = clusters[faces]
+    proxy_faces = proxy_faces[(proxy_faces[:, 0] != proxy_faces[:, 1])
+                              & (proxy_faces[:, 1] != proxy_faces[:, 2])
+                              & (proxy_faces[:, 2] != proxy_faces[:, 0])]
+    _, first = np.unique(np.sort(proxy_faces, axis=1), axis=0, return_index=True)
+    return proxy_vertices, proxy_faces[np.sort(first)]
+
+
+def cluster_means(values, clusters, count):
+    """Mean of `values` (one row per vertex) over each cluster"""
+    values = np.asarray(values, dtype=np.float64)
+    sizes = np.bincount(clusters, minlength=count)[:, np.newaxis]
+    means = np.empty((count, values.shape[1]))
+    for column in range(values.shape[1]):
+        means[:, column] = np.bincount(clusters, values[:, column], minlength=count)
+    return means / sizes
+
+
+def transfer_matrix(proxy_vertices, vertices, neighbors=4):
+    """Sparse (vertex count, proxy vertex count) matrix interpolating the
+    displacements of the proxy at the full resolution vertices. Rows sum to
+    one. It is returned in CSC format, to select the columns of the proxy
+    vertices that moved."""
+    neighbors = min(neighbors, len(proxy_vertices))
+    distances, indices = scipy.spatial.cKDTree(proxy_vertices).query(vertices, k=neighbors, workers=-1)
+    distances = distances.reshape(len(vertices), neighbors)
+    indices = indices.reshape(len(vertices), neighbors)
+    weights = 1.0 / np.maximum(distances, 1e-12)
+    weights /= weights.sum(axis=1, keepdims=True)
+    indptr = np.arange(0, len(vertices) * neighbors + 1, neighbors)
+    return scipy.sparse.csr_matrix((weights.ravel(), indices.ravel(), indptr),
+                                   shape=(len(vertices), len(proxy_vertices))).tocsc()
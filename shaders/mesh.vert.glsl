@@ -27,6 +27,8 @@
 in vec3 in_vert;
 in vec3 in_normal;
 in vec4 in_color;
+// Fraction of uHandleShift the vertex follows, to preview a drag
+in float in_weight;
 
 out vec3 v_normal;
 out vec3 v_position;
@@ -34,10 +36,11 @@ out vec4 v_color;
 
 uniform mat4 uPerspectiveMatrix;
 uniform mat4 uViewMatrix;
+uniform vec3 uHandleShift = vec3(0.0);
 
 void main() {
     v_normal = in_normal;
-    v_position = in_vert;
+    v_position = in_vert + in_weight * uHandleShift;
     v_color = in_color;
     gl_Position = uPerspectiveMatrix * uViewMatrix * vec4(v_position, 1.0);
 }
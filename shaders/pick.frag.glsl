@@ -0,0 +1,14 @@
+#version 330
+
+// Picking pass: writes the index of the triangle (offset by one, so that 0
+// means background) and the world position of the visible surface.
+
+in vec3 v_position;
+
+layout(location = 0) out int f_face;
+layout(location = 1) out vec4 f_position;
+
+void main() {
+    f_face = gl_PrimitiveID + 1;
+    f_position = vec4(v_position, 1.0);
+}
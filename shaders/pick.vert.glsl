@@ -0,0 +1,16 @@
+#version 330
+
+// Picking pass: same transform as mesh.vert.glsl, but only forwards the
+// world position, which is written to the position attachment.
+
+in vec3 in_vert;
+
+out vec3 v_position;
+
+uniform mat4 uPerspectiveMatrix;
+uniform mat4 uViewMatrix;
+
+void main() {
+    v_position = in_vert;
+    gl_Position = uPerspectiveMatrix * uViewMatrix * vec4(v_position, 1.0);
+}
@@ -8,6 +8,26 @@ def _perspective(n, f, t, b, l, r):
         [     0    ,     0    ,       -1      ,       0        ],
     ])
 
+def rotation_x(angle):
+    c, s = np.cos(angle), np.sin(angle)
+    return np.array([[1, 0, 0], [0, c, -s], [0, s, c]])
+
+def rotation_y(angle):
+    c, s = np.cos(angle), np.sin(angle)
+    return np.array([[c, 0, s], [0, 1, 0], [-s, 0, c]])
+
+def resample_polyline(points, spacing):
+    """Points every `spacing` along a polyline, both of its ends included"""
+    points = np.asarray(points, dtype=np.float64)
+    lengths = np.linalg.norm(np.diff(points, axis=0), axis=1)
+    # Repeated points would make the arc length non increasing
+    points = points[np.concatenate([[True], lengths > 0])]
+    distances = np.concatenate([[0.0], np.cumsum(lengths[lengths > 0])])
+    if distances[-1] == 0:
+        return points
+    samples = np.append(np.arange(0.0, distances[-1], spacing), distances[-1])
+    return np.stack([np.interp(samples, distances, points[:, axis]) for axis in range(points.shape[1])], axis=1)
+
 def perspective(fovy, aspect, near, far):
     top = near * np.tan(fovy / 2)
     right = top * aspect
@@ -0,0 +1,65 @@
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Cancelled(Exception):
+    """Raised inside a task when a newer task was submitted"""
+
+
+class BackgroundTask:
+    """Runs computations one at a time on a worker thread, so that the render
+    loop keeps running meanwhile.
+
+    Only the latest submission matters: submitting again cancels the previous
+    task, which stops at its next progress report, and its result is never
+    returned. The main loop calls `poll` every frame to get the result."""
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.generation = 0
+        self.future = None
+        self.context = None
+        self.progress = 0.0
+
+    def submit(self, function, *args, context=None):
+        """Run function(*args, progress=report) on the worker thread. The task
+        reports its progress by calling report with a fraction in [0, 1].
+        `context` is handed back with the result."""
+        self.generation += 1
+        generation = self.generation
+        self.progress = 0.0
+
+        def report(fraction):
+            if generation != self.generation:
+                raise Cancelled()
+            self.progress = fraction
+
+        self.context = context
+        self.future = self.executor.submit(function, *args, progress=report)
+
+    @property
+    def pending(self):
+        return self.future is not None
+
+    def poll(self):
+        """Return (context, result) of the last submitted task once it is
+        done, None otherwise. A task that raised an exception is reported and
+        discarded, rather than taking down the main loop."""
+        if self.future is None or not self.future.done():
+            return None
+        future, self.future = self.future, None
+        error = future.exception()
+        if error is not None:
+            print("(Background task failed)")
+            traceback.print_exception(error)
+            return None
+        return self.context, future.result()
+
+    def cancel(self):
+        self.generation += 1
+        if self.future is not None:
+            self.future.cancel()
+            self.future = None
+
+    def shutdown(self):
+        self.cancel()
+        self.executor.shutdown(wait=False)